@@ -0,0 +1,666 @@
+import os
+import copy
+import time
+import queue
+import threading
+from multiprocessing import shared_memory
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader
+try:
+    from torch.ao.nn.intrinsic import ConvReLU2d
+except ImportError:
+    from torch.nn.intrinsic import ConvReLU2d
+from PIL import Image
+import matplotlib.pyplot as plt
+
+## uint8 batches (--uint8 on) are cast and normalized on the device in one pass
+# memory_format: the cast also reorders the batch (channels_last), so it is written once
+def to_float(x, mean=0.0, std=1.0, memory_format=torch.preserve_format):
+    if x.dtype != torch.uint8:
+        return x if memory_format == torch.preserve_format else x.contiguous(memory_format=memory_format)
+
+    return x.to(torch.float32, memory_format=memory_format).mul_(1 / (255.0 * std)).sub_(mean / std)
+
+## mixed precision (--precision fp32|bf16|fp16)
+# forward pass and loss run under autocast, the weights and the optimizer state stay fp32.
+# fp16 needs loss scaling against gradient underflow (GradScaler), bf16 has the fp32 exponent range
+class Precision(object):
+    def __init__(self, precision, device):
+        self.precision = precision
+        self.device = device
+        self.dtype = {'fp32': torch.float32, 'bf16': torch.bfloat16, 'fp16': torch.float16}[precision]
+
+        enabled = precision == 'fp16'
+
+        try:
+            self.scaler = torch.amp.GradScaler(device.type, enabled=enabled)
+        except (AttributeError, TypeError):
+            # torch < 2.3: loss scaling is cuda only, fp16 without it would let gradients underflow
+            if enabled and device.type != 'cuda':
+                raise ValueError("--precision fp16 on %s needs torch >= 2.3 (GradScaler), use bf16" % device.type)
+
+            self.scaler = torch.cuda.amp.GradScaler(enabled=enabled)
+
+    def autocast(self):
+        return torch.autocast(device_type=self.device.type, dtype=self.dtype, enabled=self.precision != 'fp32')
+
+    def step(self, loss, optim):
+        self.scaler.scale(loss).backward()
+        self.scaler.step(optim)
+        self.scaler.update()
+
+## compiled execution (--compile on|script)
+# on: torch.compile, specialized to the fixed crop shape (ny, nx) with a dynamic batch dimension,
+# so a smaller last batch does not recompile (a batch of 1 compiles once more); TorchScript if it fails.
+# every other (ny, nx) is a full recompile, which is why --bucket does not combine with --compile
+# script: torch.jit.script, frozen (weights folded in as constants) for inference
+# the returned module shares the parameters of net, checkpoints are still saved from net
+def compile_net(net, mode, shape, device, train=True, amp=None, nstep=5, memory_format=torch.contiguous_format):
+    x = torch.randn(shape, device=device).contiguous(memory_format=memory_format)
+
+    if hasattr(torch, '_dynamo'):
+        torch._dynamo.mark_dynamic(x, 0)
+
+    # warmup steps must not leave running statistics or gradients behind
+    state = {key: value.clone() for key, value in net.state_dict().items()}
+
+    t_eager = time_step(net, x, train, amp, nstep)
+
+    net_compiled = None
+
+    if mode == "on" and hasattr(torch, 'compile'):
+        try:
+            net_compiled = torch.compile(net)
+            time_step(net_compiled, x, train, amp, 1)
+        except Exception as e:
+            print("COMPILE: torch.compile failed (%s), TorchScript fallback" % type(e).__name__)
+            net_compiled = None
+
+    if net_compiled is None:
+        net_compiled = torch.jit.script(net)
+
+        if not train:
+            net_compiled = torch.jit.freeze(net_compiled.eval())
+
+        time_step(net_compiled, x, train, amp, 1)
+
+    t_compiled = time_step(net_compiled, x, train, amp, nstep)
+
+    net.load_state_dict(state)
+    net.zero_grad(set_to_none=True)
+
+    print("COMPILE: %s | SHAPE %s | EAGER %.1f ms | COMPILED %.1f ms | SPEEDUP %.2fx" %
+          (type(net_compiled).__name__, tuple(shape), 1e3 * t_eager, 1e3 * t_compiled, t_eager / t_compiled))
+
+    return net_compiled
+
+def time_step(net, x, train=True, amp=None, nstep=5):
+    # seconds per forward (+ backward) step
+    net.train(train)
+
+    for i in range(nstep + 1):
+        # the first step is not timed
+        if i == 1:
+            if x.is_cuda:
+                torch.cuda.synchronize()
+            t = time.time()
+
+        with torch.set_grad_enabled(train), (amp.autocast() if amp is not None else torch.autocast(x.device.type, enabled=False)):
+            output = net(x)
+
+        if train:
+            output.float().mean().backward()
+
+    if x.is_cuda:
+        torch.cuda.synchronize()
+
+    return (time.time() - t) / nstep
+
+## Conv-BatchNorm folding for inference (eval/test)
+# in eval mode BatchNorm2d is a fixed per channel affine map, so it is folded into the weights
+# and bias of the Conv2d before it: w' = w * g / sqrt(var + eps), b' = (b - mean) * g / sqrt(var + eps) + beta
+# relu=True: Conv2d + ReLU pairs become one ConvReLU2d module with an in-place ReLU
+# x: a sample batch, the fused copy is checked against net on it; above rtol it is
+# dropped with a warning and net itself is returned
+def fuse_for_inference(net, x=None, relu=False, rtol=1e-4):
+    net_fused = copy.deepcopy(net).eval()
+
+    nbn, nrelu = 0, 0
+
+    for module in list(net_fused.modules()):
+        if not isinstance(module, nn.Sequential):
+            continue
+
+        layers = list(module.children())
+
+        for i in range(len(layers) - 1):
+            if isinstance(layers[i], nn.Conv2d) and isinstance(layers[i + 1], nn.BatchNorm2d) \
+                    and layers[i + 1].track_running_stats:
+                layers[i] = fuse_conv_bn(layers[i], layers[i + 1])
+                layers[i + 1] = nn.Identity()
+                nbn += 1
+
+        if relu:
+            for i in range(len(layers) - 1):
+                j = i + 1
+
+                # the folded BatchNorm left an Identity between the conv and the ReLU
+                while j < len(layers) - 1 and isinstance(layers[j], nn.Identity):
+                    j += 1
+
+                if type(layers[i]) is nn.Conv2d and type(layers[j]) is nn.ReLU:
+                    layers[i] = ConvReLU2d(layers[i], nn.ReLU(inplace=True))
+                    layers[j] = nn.Identity()
+                    nrelu += 1
+
+        # Identity slots are dropped, the module names (checkpoint keys) of the rest are kept
+        for name, layer in zip(list(module._modules), layers):
+            if isinstance(layer, nn.Identity):
+                del module._modules[name]
+            else:
+                module._modules[name] = layer
+
+    err = 0.0
+
+    if x is not None:
+        with torch.no_grad():
+            training = net.training
+
+            y = net.eval()(x)
+            y_fused = net_fused(x)
+
+            net.train(training)
+
+        err = ((y - y_fused).abs().max() / y.abs().max().clamp(min=1e-12)).item()
+
+        if err > rtol:
+            print("FUSE: RELATIVE ERROR %.2e ABOVE %.0e, KEEPING THE UNFUSED NETWORK" % (err, rtol))
+            return net
+
+    print("FUSE: CONV-BN %d | CONV-RELU %d | ERROR %.2e" % (nbn, nrelu, err))
+
+    return net_fused
+
+def fuse_conv_bn(conv, bn):
+    conv_fused = copy.deepcopy(conv)
+
+    with torch.no_grad():
+        # affine=False: weight 1, bias 0
+        weight = bn.weight if bn.weight is not None else torch.ones_like(bn.running_var)
+        shift = bn.bias if bn.bias is not None else torch.zeros_like(bn.running_mean)
+        bias = conv.bias if conv.bias is not None else torch.zeros_like(bn.running_mean)
+
+        scale = weight / torch.sqrt(bn.running_var + bn.eps)
+
+        conv_fused.weight.copy_(conv.weight * scale.reshape(-1, 1, 1, 1))
+        conv_fused.bias = nn.Parameter((bias - bn.running_mean) * scale + shift)
+
+    return conv_fused
+
+## device prefetcher (stays one batch ahead of the training loop)
+# cuda: batches are pinned and copied with non_blocking on a side stream while
+# the current batch is computed. cpu: a background thread collates the next batch.
+class DevicePrefetcher(object):
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = torch.device(device)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        if self.device.type == 'cuda':
+            return self.iter_cuda()
+        else:
+            return self.iter_thread()
+
+    def to_device(self, data):
+        for key, value in data.items():
+            if torch.is_tensor(value):
+                if self.device.type == 'cuda' and not value.is_pinned():
+                    value = value.pin_memory()
+                data[key] = value.to(self.device, non_blocking=True)
+
+        return data
+
+    def iter_cuda(self):
+        stream = torch.cuda.Stream(device=self.device)
+        current = torch.cuda.current_stream(self.device)
+
+        it = iter(self.loader)
+
+        def preload():
+            data = next(it, None)
+
+            if data is not None:
+                with torch.cuda.stream(stream):
+                    data = self.to_device(data)
+
+            return data
+
+        data = preload()
+
+        while data is not None:
+            # the copy must be finished before the batch is used on the compute stream
+            current.wait_stream(stream)
+
+            for value in data.values():
+                if torch.is_tensor(value):
+                    value.record_stream(current)
+
+            next_data = preload()
+            yield data
+            data = next_data
+
+    def iter_thread(self):
+        buffer = queue.Queue(maxsize=1)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    buffer.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+
+            return False
+
+        def worker():
+            try:
+                for data in self.loader:
+                    if not put(('data', self.to_device(data))):
+                        return
+                put(('end', None))
+            except Exception as e:
+                put(('error', e))
+
+        thread = threading.Thread(target=worker, daemon=True)
+        thread.start()
+
+        try:
+            while True:
+                kind, item = buffer.get()
+
+                if kind == 'end':
+                    break
+                elif kind == 'error':
+                    raise item
+
+                yield item
+        finally:
+            # also reached when the loop breaks early, the thread then stops at its next put
+            stop.set()
+            thread.join()
+
+## DataLoader tuning (num_workers, prefetch_factor, persistent_workers)
+# calibrate() loads a few batches with 0, 1, 2, 4 and 8 workers (at most max_probe)
+# and keeps the smallest count within 10% of the best throughput. Iterating the tuner
+# measures the time the loop waits on the loader against the time spent between
+# batches (compute); after each pass workers (then prefetch) are added when the loop
+# waited more than wait_high. A worker is only released after patience passes in a
+# row below wait_low, and never down to a count that was already grown out of, so
+# the persistent workers are not restarted back and forth.
+class LoaderTuner(object):
+    def __init__(self, dataset, max_workers=None, wait_high=0.1, wait_low=0.02, patience=3, max_probe=8, **kwargs):
+        self.dataset = dataset
+        self.kwargs = kwargs
+        self.wait_high = wait_high
+        self.wait_low = wait_low
+        self.patience = patience
+        self.max_probe = max_probe
+
+        if max_workers is None:
+            if hasattr(os, 'sched_getaffinity'):
+                max_workers = len(os.sched_getaffinity(0))
+            else:
+                max_workers = os.cpu_count()
+
+        self.max_workers = max_workers
+
+        self.num_workers = min(8, max_workers)
+        self.prefetch_factor = 2
+        self.persistent_workers = True
+
+        # lowest count adapt() may shrink to, and the low wait passes in a row
+        self.min_workers = 1
+        self.num_low = 0
+
+        self.loader = None
+        self.time_wait = 0.0
+        self.time_compute = 0.0
+
+    def build(self, persistent_workers=None):
+        kwargs = dict(self.kwargs)
+
+        if persistent_workers is None:
+            persistent_workers = self.persistent_workers
+
+        if self.num_workers > 0:
+            kwargs.update(prefetch_factor=self.prefetch_factor, persistent_workers=persistent_workers)
+
+        return DataLoader(self.dataset, num_workers=self.num_workers, **kwargs)
+
+    def get_loader(self):
+        # kept (with its persistent workers) until the setting changes
+        if self.loader is None:
+            self.loader = self.build()
+
+        return self.loader
+
+    def __len__(self):
+        return len(self.get_loader())
+
+    def calibrate(self, nbatch=10):
+        # the first batch is the startup time, the throughput needs at least one more
+        nbatch = min(nbatch, len(self.get_loader()) - 1)
+        self.loader = None
+
+        default = self.num_workers
+
+        if nbatch < 1:
+            print("LOADER: CALIBRATE | SKIPPED, FEWER THAN 2 BATCHES | NUM_WORKERS %d" % default)
+            return self
+
+        candidates = sorted(set([0] + [min(2 ** i, self.max_workers, self.max_probe) for i in range(4)]))
+        result = []
+
+        for num_workers in candidates:
+            self.num_workers = num_workers
+            # the probe workers exit with their iterator
+            it = iter(self.build(persistent_workers=False))
+
+            t0 = time.perf_counter()
+            first = next(it, None)
+            t1 = time.perf_counter()
+
+            # batches actually drawn, the sampler may yield fewer than len()
+            ndrawn = 0
+
+            if first is not None:
+                for _ in range(nbatch):
+                    if next(it, None) is None:
+                        break
+                    ndrawn += 1
+            t2 = time.perf_counter()
+
+            del it
+
+            if ndrawn == 0:
+                continue
+
+            result += [(num_workers, t1 - t0, ndrawn / (t2 - t1))]
+
+            print("LOADER: CALIBRATE | NUM_WORKERS %d | STARTUP %.3fs | %.1f BATCH/s" % result[-1])
+
+        if not result:
+            print("LOADER: CALIBRATE | SKIPPED, FEWER THAN 2 BATCHES | NUM_WORKERS %d" % default)
+            self.num_workers = default
+            self.loader = None
+            return self
+
+        best = max([r[2] for r in result])
+        num_workers, startup, throughput = [r for r in result if r[2] >= 0.9 * best][0]
+
+        # workers are only kept alive when starting them is a noticeable part of a pass
+        self.num_workers = num_workers
+        self.persistent_workers = num_workers > 0 and startup > 0.02 * len(self.get_loader()) / throughput
+        self.loader = None
+
+        return self
+
+    def adapt(self):
+        total = self.time_wait + self.time_compute
+
+        if total <= 0:
+            return
+
+        wait = self.time_wait / total
+        setting = (self.num_workers, self.prefetch_factor)
+
+        self.num_low = self.num_low + 1 if wait < self.wait_low else 0
+
+        if wait > self.wait_high:
+            if self.num_workers < self.max_workers:
+                # the loop waited with this count, it is not tried again
+                self.min_workers = max(self.min_workers, self.num_workers + 1)
+                self.num_workers = min(self.max_workers, self.num_workers + max(1, self.num_workers // 2))
+            elif self.num_workers > 0 and self.prefetch_factor < 8:
+                self.prefetch_factor *= 2
+        elif self.num_low >= self.patience and self.num_workers > self.min_workers:
+            self.num_workers -= 1
+            self.num_low = 0
+
+        print("LOADER: WAIT %.1f%% | NUM_WORKERS %d | PREFETCH %d" % (100 * wait, self.num_workers, self.prefetch_factor))
+
+        if (self.num_workers, self.prefetch_factor) != setting:
+            self.loader = None
+
+    def __iter__(self):
+        self.time_wait = 0.0
+        self.time_compute = 0.0
+
+        it = iter(self.get_loader())
+
+        # the first batch carries the worker startup and is not counted
+        data = next(it, None)
+
+        while data is not None:
+            t0 = time.perf_counter()
+            yield data
+            t1 = time.perf_counter()
+
+            data = next(it, None)
+            t = time.perf_counter()
+
+            self.time_compute += t1 - t0
+            self.time_wait += t - t1
+
+        self.adapt()
+
+## background image writer (png dumps of the train/val/test loops)
+# the loop only hands over a copy of the image, PNG encoding and the file write run in
+# num_threads threads behind a queue of maxsize items. A full queue drops the image
+# (drop=True, per batch dumps) or blocks the loop until there is room (drop=False, results)
+class ImageWriter(object):
+    def __init__(self, maxsize=16, num_threads=2, drop=True):
+        self.drop = drop
+        self.queue = queue.Queue(maxsize)
+
+        self.num_written = 0
+        self.num_dropped = 0
+        self.num_failed = 0
+        self.lock = threading.Lock()
+
+        self.threads = [threading.Thread(target=self.run, daemon=True) for _ in range(num_threads)]
+
+        for thread in self.threads:
+            thread.start()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+
+            if item is None:
+                return
+
+            fn, path, img, kwargs = item
+
+            try:
+                fn(path, img, **kwargs)
+            except Exception as e:
+                print("IMAGE WRITER: %s failed (%s: %s)" % (path, type(e).__name__, e))
+
+                with self.lock:
+                    self.num_failed += 1
+            else:
+                with self.lock:
+                    self.num_written += 1
+
+    def put(self, fn, path, img, drop=None, **kwargs):
+        # the snapshot keeps later in-place changes of the caller out of the file
+        item = (fn, path, np.array(img, copy=True), kwargs)
+
+        if not (self.drop if drop is None else drop):
+            self.queue.put(item)
+            return True
+
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            with self.lock:
+                self.num_dropped += 1
+            return False
+
+        return True
+
+    def imsave(self, path, img, drop=None, **kwargs):
+        return self.put(plt.imsave, path, img, drop, **kwargs)
+
+    def save(self, path, arr, drop=None):
+        return self.put(np.save, path, arr, drop)
+
+    def close(self):
+        # everything queued so far is written before the threads stop
+        for _ in self.threads:
+            self.queue.put(None)
+
+        for thread in self.threads:
+            thread.join()
+
+        print("IMAGE WRITER: WRITTEN %d | DROPPED %d | FAILED %d" % (self.num_written, self.num_dropped, self.num_failed))
+
+## numpy arrays in shared memory (one copy for all DataLoader workers)
+# the arrays are packed into one block; pickling only sends the block name and
+# the layout, so spawned workers attach instead of copying, and forked workers
+# read the same pages without touching python objects (no refcount churn)
+class SharedStore(object):
+    def __init__(self, arrays, empty=None):
+        # arrays: {key: array} copied in, empty: {key: (shape, dtype)} left uninitialized
+        specs = [(key, value.shape, value.dtype) for key, value in arrays.items()]
+        specs += [(key, tuple(shape), np.dtype(dtype)) for key, (shape, dtype) in (empty or {}).items()]
+
+        self.layout = []
+        offset = 0
+
+        for key, shape, dtype in specs:
+            offset = (offset + 63) // 64 * 64
+            self.layout += [(key, shape, dtype, offset)]
+            offset += int(np.prod(shape)) * dtype.itemsize
+
+        self.pid = os.getpid()
+        self.shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+
+        self.attach()
+
+        for key, value in arrays.items():
+            self.arrays[key][...] = value
+
+    def attach(self):
+        self.arrays = {key: np.ndarray(shape, dtype=dtype, buffer=self.shm.buf, offset=offset)
+                       for key, shape, dtype, offset in self.layout}
+
+    def __getitem__(self, key):
+        return self.arrays[key]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['shm'] = self.shm.name
+        del state['arrays']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.shm = shared_memory.SharedMemory(name=self.shm)
+        self.attach()
+
+    def __del__(self):
+        # views into the block must be released before it can be closed
+        self.__dict__.pop('arrays', None)
+
+        shm = self.__dict__.get('shm')
+        if isinstance(shm, shared_memory.SharedMemory):
+            shm.close()
+            # only the creating process unlinks the block
+            if self.pid == os.getpid():
+                shm.unlink()
+
+## dataset manifest
+# file list with shape, dtype, size and mtime of every sample, saved as
+# manifest.npz in the data directory so a Dataset can start without listing
+# the directory. It is refreshed incrementally (only new or changed files are
+# probed) whenever the directory mtime changes, i.e. files were added, removed
+# or renamed; call update_manifest() directly after overwriting files in place.
+MANIFEST_NAME = 'manifest.npz'
+
+def probe_file(path):
+    if path.endswith('.npy'):
+        with open(path, 'rb') as f:
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, _, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, _, dtype = np.lib.format.read_array_header_2_0(f)
+    else:
+        # only the image header is parsed, the pixels are not decoded
+        with Image.open(path) as img:
+            shape = (img.size[1], img.size[0], len(img.getbands()))
+            dtype = {'I;16': np.uint16, 'I': np.int32, 'F': np.float32}.get(img.mode, np.uint8)
+
+    shape = tuple(shape) + (1,) * (3 - len(shape))
+
+    return shape[0], shape[1], shape[2], np.dtype(dtype).str
+
+def update_manifest(data_dir, fn_filter, manifest=None):
+    prev = {}
+    if manifest is not None:
+        prev = {name: i for i, name in enumerate(manifest['name'])}
+
+    lst = []
+
+    with os.scandir(data_dir) as entries:
+        for entry in entries:
+            if not fn_filter(entry.name):
+                continue
+
+            st = entry.stat()
+            i = prev.get(entry.name)
+
+            # unchanged files are not probed again
+            if i is not None and manifest[i]['size'] == st.st_size and manifest[i]['mtime'] == st.st_mtime_ns:
+                lst.append(manifest[i].item())
+            else:
+                lst.append((entry.name,) + probe_file(entry.path) + (st.st_size, st.st_mtime_ns))
+
+    lst.sort()
+
+    nchar = max([len(item[0]) for item in lst] + [1])
+    manifest = np.array(lst, dtype=[('name', 'U%d' % nchar), ('ny', '<i8'), ('nx', '<i8'), ('nch', '<i8'),
+                                     ('dtype', 'U8'), ('size', '<i8'), ('mtime', '<i8')])
+
+    path = os.path.join(data_dir, MANIFEST_NAME)
+    np.savez(path + '.tmp.npz', manifest=manifest)
+    os.replace(path + '.tmp.npz', path)
+
+    # saving the manifest touches the directory itself, so the directory mtime
+    # is read afterwards and stamped on the manifest file as its own mtime
+    dir_mtime = os.stat(data_dir).st_mtime_ns
+    os.utime(path, ns=(dir_mtime, dir_mtime))
+
+    return manifest
+
+def load_manifest(data_dir, fn_filter):
+    path = os.path.join(data_dir, MANIFEST_NAME)
+
+    if not os.path.exists(path):
+        return update_manifest(data_dir, fn_filter)
+
+    with np.load(path) as f:
+        manifest = f['manifest']
+
+    if os.stat(path).st_mtime_ns != os.stat(data_dir).st_mtime_ns:
+        manifest = update_manifest(data_dir, fn_filter, manifest)
+
+    return manifest
@@ -1,5 +1,6 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 class CBR2d(nn.Module):
     def __init__(self, in_channels, out_channels, kernel_size=3, stride=1, padding=1, bias=True, norm="bnorm", relu=0.0):
@@ -17,9 +18,8 @@ class CBR2d(nn.Module):
         if not relu is None:
             layers += [nn.ReLU() if relu == 0.0 else nn.LeakyReLU(relu)]
 
-        cbr = nn.Sequential(*layers)  # layers를 가변적인 갯수를 가진 위치 인수로 정의
+        self.cbr = nn.Sequential(*layers)  # layers를 가변적인 갯수를 가진 위치 인수로 정의
 
-        return cbr
     def forward(self, x):
         return self.cbr(x)
 
@@ -39,6 +39,7 @@ class ResBlock(nn.Module):
         return x + self.resblk(x)
 
 
+# sub-pixel convolution, (B, C * ry * rx, H, W) -> (B, C, H * ry, W * rx)
 class PixelShuffle(nn.Module):
     def __init__(self, ry, rx):
         super().__init__()
@@ -49,14 +50,19 @@ class PixelShuffle(nn.Module):
         ry = self.ry
         rx = self.rx
 
-        [B, C, H, W] = list(x.shape)
+        # native kernel, keeps channels_last
+        if ry == rx:
+            return F.pixel_shuffle(x, ry)
 
-        x = x.reshape(B, C, H // ry, ry, W // rx, rx)
-        x = x.permute(0, 1, 3, 5, 2, 4)
-        x = x.reshape(B, C * ry * rx, H // ry, W // rx)
+        B, C, H, W = x.shape
 
-        return x
+        y = x.reshape(B, C // (ry * rx), ry, rx, H, W)
+        y = y.permute(0, 1, 4, 2, 5, 3)
+        y = y.reshape(B, C // (ry * rx), H * ry, W * rx)
 
+        return y.contiguous(memory_format=torch.channels_last) if x.is_contiguous(memory_format=torch.channels_last) else y
+
+# (B, C, H, W) -> (B, C * ry * rx, H / ry, W / rx)
 class PixelUnshuffle(nn.Module):
     def __init__(self, ry=2, rx=2):
         super().__init__()
@@ -67,9 +73,14 @@ class PixelUnshuffle(nn.Module):
         ry = self.ry
         rx = self.rx
 
-        [B, C, H, W] = list(x.shape)
+        # native kernel, keeps channels_last
+        if ry == rx:
+            return F.pixel_unshuffle(x, ry)
+
+        B, C, H, W = x.shape
+
+        y = x.reshape(B, C, H // ry, ry, W // rx, rx)
+        y = y.permute(0, 1, 3, 5, 2, 4)
+        y = y.reshape(B, C * ry * rx, H // ry, W // rx)
 
-        x = x.reshape(B, C // (ry * rx), ry, rx, H, W)
-        x = x.permute(0, 1, 4, 2, 5, 3)
-        x = x.reshape(B, C // (ry * rx), H * ry, W * rx)
-        return x
\ No newline at end of file
+        return y.contiguous(memory_format=torch.channels_last) if x.is_contiguous(memory_format=torch.channels_last) else y
@@ -113,7 +113,7 @@ class UNet(nn.Module):
 
 class AutoEncoder(nn.Module):
     def __init__(self, in_channels, out_channels, nker, norm="bnorm", learning_type="plain"):
-        super(UNet, self).__init__()
+        super(AutoEncoder, self).__init__()
 
         self.learning_type = learning_type
 
@@ -238,6 +238,8 @@ class SRResNet(nn.Module):
             res += [ResBlock(nker, nker, kernel_size=3, stride=1, padding=1, bias=True,
                              norm=norm, relu=0.0)]
 
+        self.res = nn.Sequential(*res)
+
         self.dec = CBR2d(nker, nker, kernel_size=3, stride=1, padding=1, bias=True,
                              norm=norm, relu=None)
 
@@ -282,7 +284,7 @@ class ResNet(nn.Module):
         super(ResNet, self).__init__()
         self.learning_type = learning_type
 
-        self.enc = CBR2d(in_channels=in_channels, out_channels=out_channels, kernel_size=3,
+        self.enc = CBR2d(in_channels=in_channels, out_channels=nker, kernel_size=3,
                          stride=1, bias=True, norm=None, relu=.0) #enc has no normalization term
 
         res = []
@@ -295,7 +297,7 @@ class ResNet(nn.Module):
         self.dec = CBR2d(nker, nker, kernel_size=3, stride=1, padding=1, bias=True, norm=norm, relu=0.0)
 
         self.fc = nn.Conv2d(in_channels=nker, out_channels=out_channels, kernel_size=1,
-                            stride=1, padding=1, bias=True) # same as unet, kernel size=1
+                            stride=1, padding=0, bias=True) # same as unet, kernel size=1
 
     def forward(self, x):
         x0 = x # residual learning type
@@ -306,7 +308,7 @@ class ResNet(nn.Module):
 
         if self.learning_type == "plain":
             x = self.fc(x)
-        elif self.learning_type == "resnet":
+        elif self.learning_type == "residual":
             x = x0 + self.fc(x)
 
         return x
@@ -1,12 +1,22 @@
 
 import os
+import sys
+import shutil
+import hashlib
+import time
+from functools import lru_cache
 import numpy as np
 import torch
 import torch.nn as nn
-from scipy.stats import poisson
+import torch.nn.functional as F
 from scipy.io import loadmat
+from scipy import sparse
 from skimage.transform import radon, iradon, rescale, resize
 
+## loader, device and runtime helpers shared by the three projects (../common/runtime.py)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from common.runtime import *
+
 ## network saving
 def save(ckpt_dir, net, optim, epoch):
     if not os.path.exists(ckpt_dir):
@@ -31,25 +41,34 @@ def load(ckpt_dir, net, optim):
 
     return net, optim, epoch
 
-## sampling
-def add_sampling(img, type="random", opts=None):
-    sz = img.shape
+## random generator of the process
+# every DataLoader worker gets its own PCG64 stream from seed_worker (worker_init_fn),
+# so forked workers never draw the same noise; the main process uses a fresh stream
+rng = np.random.default_rng()
 
-    if type =="uniform":
-        ds_y = opts[0].astype(np.int)
-        ds_x = opts[1].astype(np.int)
+def get_rng():
+    return rng
 
-        msk = np.zeros(sz)
-        msk[::ds_y, ::ds_x, :] = x
+def seed_worker(worker_id):
+    global rng
 
-        dst = img * msk
-    elif type =="random":
-        rnd = np.random.rand(sz[0], sz[1], sz[2])
-        prob = opts[0]
-        msk = (rnd > prob).astype(np.float)
+    # torch hands every worker a distinct seed (base seed + worker id)
+    seed = torch.initial_seed()
 
+    rng = np.random.Generator(np.random.PCG64([seed % 2 ** 64, worker_id]))
+    np.random.seed([seed % 2 ** 32, worker_id])
 
-        dst = img * msk
+## sampling
+# the uniform grid and the gaussian probability field only depend on the image
+# shape and the opts, so they are built once per (type, shape, opts) and reused
+@lru_cache(maxsize=32)
+def sampling_field(type, sz, opts):
+    if type == "uniform":
+        ds_y = int(opts[0])
+        ds_x = int(opts[1])
+
+        field = np.zeros(sz, dtype=bool)
+        field[::ds_y, ::ds_x, :] = True
     elif type == "gaussian":
         ly = np.linspace(-1, 1, sz[0])
         lx = np.linspace(-1, 1, sz[1])
@@ -64,35 +83,72 @@ def add_sampling(img, type="random", opts=None):
         a = opts[4]
 
         gaus = a * np.exp(-((x - x0) ** 2 / (2 * sgmx ** 2) + (y - y0) ** 2 / (2 * sgmy ** 2)))
-        gaus = np.tile(gaus[:, :, np.newaxis], (1, 1, sz[2]))
 
-        rnd = np.random.rand(sz[0], sz[1], sz[2])
-        msk = (rnd < gaus).astype(np.float)
+        # broadcast over the channels instead of np.tile
+        field = gaus[:, :, np.newaxis].astype(np.float32)
 
-        dst = img * msk
+    # shared between calls, must not be modified
+    field.setflags(write=False)
+
+    return field
+
+# mask: return the sampling mask as bool (1 byte per pixel) instead of the sampled image
+def add_sampling(img, type="random", opts=None, rng=None, mask=False):
+    rng = rng if rng is not None else get_rng()
+
+    sz = img.shape
+
+    if type =="uniform":
+        msk = sampling_field(type, sz, tuple(float(o) for o in opts[:2]))
+    elif type =="random":
+        rnd = rng.random(sz, dtype=np.float32)
+        prob = opts[0]
+        msk = rnd > prob
+    elif type == "gaussian":
+        gaus = sampling_field(type, sz, tuple(float(o) for o in opts[:5]))
+
+        rnd = rng.random(sz, dtype=np.float32)
+        msk = rnd < gaus
+
+    if mask:
+        return msk
+
+    dst = img * msk
 
     return dst
 # Add noise
-def add_noise(img, type='random', opts=None):
+# rng: numpy Generator (default: the stream of this process, see seed_worker)
+# out: float32 buffer of the image shape to write into (default: a new one). "random" draws
+# straight into it; "poisson" still allocates its rate (255 * img) and the int64 counts of
+# Generator.poisson, which has no out argument, and only the division is written into out
+def add_noise(img, type='random', opts=None, rng=None, out=None):
+    rng = rng if rng is not None else get_rng()
     sz = img.shape
 
+    if out is None:
+        out = np.empty(sz, dtype=np.float32)
+
     if type == "random":
         sgm = opts[0]
-        noise = sgm / 255.0 * np.random.rand(sz[0], sz[1], sz[2])
-        dst = img + noise
+        rng.random(sz, dtype=np.float32, out=out)
+        out *= sgm / 255.0
+        out += img
     elif type == "poisson":
-        dst = poisson.rvs(255.0 * img) / 255.0  # discretization then normalization
-        noise = dst - img
+        np.divide(rng.poisson(255.0 * img), 255.0, out=out)  # discretization then normalization
+
+    dst = out
     return dst
 
-def add_blur(img, type="bilinear", opts=None):
+# backend: "skimage" (resize), "matrix" (separable resize matrices, same result as
+# skimage) or "torch" (F.interpolate on float32, nearest/bilinear/bicubic only)
+def add_blur(img, type="bilinear", opts=None, backend="skimage"):
     if type == "nearest":
         order = 0
     elif type == "bilinear":
         order = 1
     elif type == "biquadratic":
         order = 2
-    elif type == " bicubic":
+    elif type == "bicubic":
         order = 3
     elif type == "biquartic":
         order = 4
@@ -100,11 +156,26 @@ def add_blur(img, type="bilinear", opts=None):
         order = 5
 
     sz = img.shape
-    dw = opts[0]
+    dw = int(opts[0])
     if len(opts) == 1:
         keepdim = True
     else:
         keepdim = opts[1]
+
+    if backend == "torch":
+        src = torch.from_numpy(np.ascontiguousarray(img.transpose((2, 0, 1)), dtype=np.float32))[np.newaxis]
+        dst = add_blur_batch(src, type=type, opts=[dw, keepdim])
+
+        return dst[0].numpy().transpose((1, 2, 0))
+
+    if backend == "matrix":
+        dst = resize_matrix(img, (sz[0] // dw, sz[1] // dw), order=order)
+
+        if keepdim:
+            dst = resize_matrix(dst, (sz[0], sz[1]), order=order)
+
+        return dst
+
     # dst = rescale(img, scale=(dw, dw, 1), order=order)
     dst = resize(img, output_shape=(sz[0]//dw, sz[1] // dw, sz[2]), order=order)
 
@@ -113,3 +184,288 @@ def add_blur(img, type="bilinear", opts=None):
 
     return dst
 
+## separable resize
+# skimage resize (spline interpolation, anti-aliasing and reflect borders) is linear
+# and separable per axis, so resizing one axis is a matrix: the response of resize
+# to every unit impulse. The matrices are built once per (size in, size out, order).
+@lru_cache(maxsize=32)
+def resize_weight(n_in, n_out, order):
+    weight = resize(np.eye(n_in), output_shape=(n_out, n_in), order=order, clip=False)
+    weight.setflags(write=False)
+
+    return weight
+
+def resize_matrix(img, shape, order=1):
+    weight_y = resize_weight(img.shape[0], shape[0], order)
+    weight_x = resize_weight(img.shape[1], shape[1], order)
+
+    dst = np.tensordot(weight_y, img, axes=(1, 0))
+    dst = np.tensordot(weight_x, dst, axes=(1, 1)).transpose((1, 0, 2))
+
+    # skimage clips the result to the input range
+    return np.clip(dst, img.min(), img.max())
+
+## accuracy of the resample backends against skimage
+# max abs difference to add_blur(backend="skimage") on a random image, per backend and type.
+# matrix reproduces skimage up to rounding (tests/test_blur.py), torch (F.interpolate) only approximates it
+# tol: ValueError when a difference is above it
+def check_blur(shape=(64, 96, 3), dw=4, keepdim=True, types=("nearest", "bilinear", "bicubic"),
+               backends=("matrix", "torch"), tol=None):
+    img = np.random.default_rng(0).random(shape)
+
+    err = {}
+    for type in types:
+        ref = add_blur(img, type=type, opts=[dw, keepdim], backend="skimage")
+
+        for backend in backends:
+            dst = add_blur(img, type=type, opts=[dw, keepdim], backend=backend)
+            err[(backend, type)] = float(np.abs(dst - ref).max())
+
+            if tol is not None and err[(backend, type)] > tol:
+                raise ValueError("add_blur %s/%s differs from skimage by %.2e (tol %.0e)" % (backend, type, err[(backend, type)], tol))
+
+    return err
+
+## sparse-view CT
+# pixel-driven parallel beam projector: every pixel center is projected onto the
+# detector for each angle and split linearly between the two nearest bins. The
+# forward matrix A (nangle * ndet, ny * nx) and its transpose (back projection) are
+# built once per (image size, angles) and saved as plain .npy files, which every
+# DataLoader worker memory-maps, so the operator is shared through the page cache.
+# each matrix has 2 * ny * nx * nangle nonzeros (float32 values, int32 indices), so both
+# take about 32 bytes per pixel and angle: 0.9 GB for 320 x 480 with 180 views
+CT_DIR = './cache/ct'
+
+def ct_angles(nangle):
+    return np.arange(nangle) * 180.0 / nangle
+
+def build_projector(shape, angles):
+    ny, nx = shape
+    ndet = int(np.ceil(np.hypot(ny, nx))) + 2
+
+    y, x = np.mgrid[:ny, :nx]
+    x = (x - (nx - 1) / 2.0).ravel()
+    y = ((ny - 1) / 2.0 - y).ravel()
+    pix = np.arange(ny * nx)
+
+    rows, cols, vals = [], [], []
+
+    for k, theta in enumerate(np.deg2rad(angles)):
+        t = x * np.cos(theta) + y * np.sin(theta) + (ndet - 1) / 2.0
+        i0 = np.floor(t).astype(np.int64)
+        w1 = t - i0
+
+        rows += [k * ndet + i0, k * ndet + i0 + 1]
+        cols += [pix, pix]
+        vals += [1.0 - w1, w1]
+
+    A = sparse.csr_matrix((np.concatenate(vals).astype(np.float32), (np.concatenate(rows), np.concatenate(cols))),
+                          shape=(len(angles) * ndet, ny * nx))
+
+    return A, ndet
+
+@lru_cache(maxsize=4)
+def ct_operator(shape, angles, ct_dir=CT_DIR):
+    key = hashlib.sha1(repr((tuple(shape), tuple(angles))).encode()).hexdigest()[:16]
+    path = os.path.join(ct_dir, 'ct_%dx%d_%d_%s' % (shape[0], shape[1], len(angles), key))
+
+    names = ['fwd_data', 'fwd_indices', 'fwd_indptr', 'bwd_data', 'bwd_indices', 'bwd_indptr']
+
+    if not os.path.exists(os.path.join(path, 'ndet.npy')):
+        A, ndet = build_projector(shape, np.asarray(angles))
+        At = A.T.tocsr()
+
+        # written to a temporary directory and renamed, so workers never see a partial operator
+        tmp = path + '.%d.tmp' % os.getpid()
+        os.makedirs(tmp, exist_ok=True)
+
+        for name, value in zip(names, [A.data, A.indices, A.indptr, At.data, At.indices, At.indptr]):
+            np.save(os.path.join(tmp, name + '.npy'), value)
+        np.save(os.path.join(tmp, 'ndet.npy'), np.array(ndet))
+
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            # another process finished first
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    arrays = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r') for name in names}
+    ndet = int(np.load(os.path.join(path, 'ndet.npy')))
+
+    npix = shape[0] * shape[1]
+    nsino = len(angles) * ndet
+
+    A = sparse.csr_matrix((arrays['fwd_data'], arrays['fwd_indices'], arrays['fwd_indptr']), shape=(nsino, npix), copy=False)
+    At = sparse.csr_matrix((arrays['bwd_data'], arrays['bwd_indices'], arrays['bwd_indptr']), shape=(npix, nsino), copy=False)
+
+    return A, At, ndet
+
+def ramp_filter(ndet):
+    npad = max(64, int(2 ** np.ceil(np.log2(2 * ndet))))
+    return 2.0 * np.abs(np.fft.rfftfreq(npad)), npad
+
+# opts = [nangle]: views over 180 degrees; the input is the filtered back projection
+def add_ct(img, opts=None, ct_dir=CT_DIR):
+    sz = img.shape
+    angles = tuple(ct_angles(int(opts[0])))
+    nangle = len(angles)
+
+    A, At, ndet = ct_operator((sz[0], sz[1]), angles, ct_dir)
+
+    # every channel is projected in the same sparse mat-vec
+    sino = (A @ img.reshape(sz[0] * sz[1], sz[2])).reshape(nangle, ndet, sz[2])
+
+    ramp, npad = ramp_filter(ndet)
+    sino = np.fft.irfft(np.fft.rfft(sino, n=npad, axis=1) * ramp[np.newaxis, :, np.newaxis], n=npad, axis=1)[:, :ndet]
+
+    dst = (At @ sino.reshape(nangle * ndet, sz[2])) * (np.pi / (2 * nangle))
+
+    return dst.reshape(sz).astype(np.float32)
+
+## accuracy and speed of add_ct against skimage radon/iradon (filtered back projection)
+# smooth test image: a few ellipses of constant value inside the inscribed disc
+def ct_phantom(shape):
+    y, x = np.mgrid[:shape[0], :shape[1]]
+    y = (y - (shape[0] - 1) / 2.0) / (min(shape[:2]) / 2.0)
+    x = (x - (shape[1] - 1) / 2.0) / (min(shape[:2]) / 2.0)
+
+    img = np.zeros(shape[:2])
+    for value, cy, cx, ry, rx in [(1.0, 0, 0, 0.8, 0.6), (-0.6, 0, -0.2, 0.3, 0.15), (-0.4, 0.1, 0.25, 0.2, 0.2), (0.3, -0.4, 0, 0.1, 0.3)]:
+        img[((y - cy) / ry) ** 2 + ((x - cx) / rx) ** 2 < 1] += value
+
+    return np.repeat(img[:, :, np.newaxis], shape[2] if len(shape) > 2 else 1, axis=2)
+
+# inside the disc: mean abs error to the clean image and seconds per image of both, the least squares
+# scale of add_ct against skimage and their mean abs difference relative to skimage (diff).
+# tol: ValueError when diff is above it, e.g. a wrong filter or back projection scaling
+def check_ct(shape=(96, 128, 1), nangle=180, ct_dir=CT_DIR, img=None, tol=None):
+    if img is None:
+        img = ct_phantom(shape)
+
+    shape = img.shape
+    theta = ct_angles(nangle)
+
+    y, x = np.mgrid[:shape[0], :shape[1]]
+    disc = (y - (shape[0] - 1) / 2.0) ** 2 + (x - (shape[1] - 1) / 2.0) ** 2 < (min(shape[:2]) / 2.0 - 2) ** 2
+
+    add_ct(img, opts=[nangle], ct_dir=ct_dir)
+
+    t = time.time()
+    dst = add_ct(img, opts=[nangle], ct_dir=ct_dir)
+    err = {'matrix': (np.abs(dst - img)[disc].mean(), time.time() - t)}
+
+    # skimage works on a square image, one channel at a time
+    n = max(shape[:2])
+    pad = ((0, n - shape[0]), (0, n - shape[1]))
+
+    t = time.time()
+    ref = np.stack([iradon(radon(np.pad(img[:, :, c], pad), theta, circle=False), theta, circle=False, output_size=n)
+                    for c in range(shape[2])], axis=2)[:shape[0], :shape[1]]
+    err['skimage'] = (np.abs(ref - img)[disc].mean(), time.time() - t)
+
+    err['scale'] = (dst[disc] * ref[disc]).sum() / (ref[disc] ** 2).sum()
+    err['diff'] = np.abs(dst - ref)[disc].mean() / np.abs(ref)[disc].mean()
+
+    if tol is not None and err['diff'] > tol:
+        raise ValueError("add_ct differs from skimage iradon by %.3f (tol %.3f), scale %.3f" % (err['diff'], tol, err['scale']))
+
+    return err
+
+## batched degradation (NCHW tensors in [0, 1], on the training device)
+def add_sampling_batch(img, type="random", opts=None):
+    sz = img.shape
+
+    if type == "uniform":
+        ds_y = int(opts[0])
+        ds_x = int(opts[1])
+
+        msk = torch.zeros_like(img)
+        msk[:, :, ::ds_y, ::ds_x] = 1
+
+        dst = img * msk
+    elif type == "random":
+        prob = opts[0]
+        msk = (torch.rand_like(img) > prob).to(img.dtype)
+
+        dst = img * msk
+    elif type == "gaussian":
+        ly = torch.linspace(-1, 1, sz[2], device=img.device, dtype=img.dtype)
+        lx = torch.linspace(-1, 1, sz[3], device=img.device, dtype=img.dtype)
+
+        y, x = torch.meshgrid(ly, lx, indexing='ij')
+
+        x0 = opts[0]
+        y0 = opts[1]
+        sgmx = opts[2]
+        sgmy = opts[3]
+
+        a = opts[4]
+
+        gaus = a * torch.exp(-((x - x0) ** 2 / (2 * sgmx ** 2) + (y - y0) ** 2 / (2 * sgmy ** 2)))
+
+        msk = (torch.rand_like(img) < gaus).to(img.dtype)
+
+        dst = img * msk
+
+    return dst
+
+def add_noise_batch(img, type='random', opts=None):
+    if type == "random":
+        sgm = opts[0]
+        noise = sgm / 255.0 * torch.rand_like(img)
+        dst = img + noise
+    elif type == "poisson":
+        dst = torch.poisson(255.0 * img.clamp(min=0)) / 255.0  # discretization then normalization
+
+    return dst
+
+def add_blur_batch(img, type="bilinear", opts=None):
+    if type not in ["nearest", "bilinear", "bicubic"]:
+        raise ValueError("add_blur_batch supports nearest, bilinear and bicubic, not %s" % type)
+
+    sz = img.shape
+    dw = int(opts[0])
+    if len(opts) == 1:
+        keepdim = True
+    else:
+        keepdim = opts[1]
+
+    # pixel centers are aligned the same way as skimage resize
+    mode = "nearest-exact" if type == "nearest" else type
+    antialias = type != "nearest"
+
+    dst = F.interpolate(img, size=(sz[2] // dw, sz[3] // dw), mode=mode, antialias=antialias)
+
+    if keepdim:
+        dst = F.interpolate(dst, size=(sz[2], sz[3]), mode=mode)
+
+    return dst
+
+def add_ct_batch(img, opts=None, ct_dir=CT_DIR, operator=None):
+    # operator: (A, At, ndet) as torch sparse tensors on the device, see ct_operator_torch
+    sz = img.shape
+    nangle = int(opts[0])
+
+    if operator is None:
+        operator = ct_operator_torch((sz[2], sz[3]), nangle, img.device, ct_dir)
+    A, At, ndet = operator
+
+    x = img.permute(2, 3, 0, 1).reshape(sz[2] * sz[3], sz[0] * sz[1])
+    sino = (A @ x).reshape(nangle, ndet, sz[0] * sz[1])
+
+    ramp, npad = ramp_filter(ndet)
+    ramp = torch.as_tensor(ramp, dtype=sino.dtype, device=sino.device)
+    sino = torch.fft.irfft(torch.fft.rfft(sino, n=npad, dim=1) * ramp[None, :, None], n=npad, dim=1)[:, :ndet]
+
+    dst = (At @ sino.reshape(nangle * ndet, -1)) * (np.pi / (2 * nangle))
+
+    return dst.reshape(sz[2], sz[3], sz[0], sz[1]).permute(2, 3, 0, 1)
+
+def ct_operator_torch(shape, nangle, device, ct_dir=CT_DIR):
+    A, At, ndet = ct_operator(tuple(shape), tuple(ct_angles(nangle)), ct_dir)
+
+    fn_torch = lambda M: torch.sparse_csr_tensor(torch.from_numpy(np.asarray(M.indptr, dtype=np.int64)),
+                                                 torch.from_numpy(np.asarray(M.indices, dtype=np.int64)),
+                                                 torch.from_numpy(np.array(M.data)), size=M.shape).to(device)
+
+    return fn_torch(A), fn_torch(At), ndet
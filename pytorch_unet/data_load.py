@@ -1,87 +1,174 @@
 ## package
+import argparse
 import os
+import json
 import numpy as np
 from PIL import Image
 import matplotlib.pyplot as plt
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from util import split_frame, ShardWriter
 
-## load data
-dir_data = './datasets'
+## parser
+parser = argparse.ArgumentParser(description='Convert the ISBI tif volumes to train/val/test datasets',
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("--data_dir", default="./datasets", type=str, dest="data_dir")
+parser.add_argument("--name_label", default="train-labels.tif", type=str, dest="name_label")
+parser.add_argument("--name_input", default="train-volume.tif", type=str, dest="name_input")
+parser.add_argument("--ratio", nargs=3, default=[0.8, 0.1, 0.1], type=float, dest="ratio")
+parser.add_argument("--seed", default=0, type=int, dest="seed")
+parser.add_argument("--num_workers", default=os.cpu_count(), type=int, dest="num_workers")
+parser.add_argument("--save_format", default="npy", choices=["npy", "shard"], type=str, dest="save_format")
+parser.add_argument("--show", default="on", type=str, dest="show")
 
-name_label = 'train-labels.tif'
-name_input = 'train-volume.tif'
+## page decoding (runs in the worker processes)
+img_label = None
+img_input = None
 
-img_label = Image.open(os.path.join(dir_data, name_label))
-img_input = Image.open(os.path.join(dir_data, name_input))
+def open_tif(path_label, path_input):
+    global img_label, img_input
+
+    img_label = Image.open(path_label)
+    img_input = Image.open(path_input)
+
+def load_frame(id):
+    img_label.seek(id)
+    img_input.seek(id)
+
+    return np.asarray(img_label), np.asarray(img_input)
+
+def convert_frame(task):
+    # task: (split, i, id) -> decode page 'id' and return it as frame 'i' of 'split'
+    split, i, id = task
+    label_, input_ = load_frame(id)
+
+    return split, i, label_, input_
 
-ny, nx = img_label.size
-nframe = img_label.n_frames
+def save_npy(path, arr):
+    # write-then-rename so an interrupted run never leaves a truncated frame behind;
+    # the temporary name does not start with label/input, so a leftover is never listed as a frame
+    path_tmp = os.path.join(os.path.dirname(path), '.tmp_' + os.path.basename(path))
+
+    np.save(path_tmp, arr)
+    os.replace(path_tmp, path)
+
+def clear_split(dir_save):
+    # frames of an earlier conversion (other ratio/seed) and leftover temporary files
+    for f in os.listdir(dir_save):
+        if (f.startswith('label_') or f.startswith('input_') or f.startswith('.tmp_')) and f.endswith('.npy'):
+            os.remove(os.path.join(dir_save, f))
 
-##
-nframe_train = 24
-nframe_val = 3
-nframe_test = 3
+## source signature (size and mtime of the tif files + split settings)
+def get_signature(path_label, path_input, args):
+    signature = {'ratio': list(args.ratio), 'seed': args.seed, 'save_format': args.save_format}
 
-dir_save_train = os.path.join(dir_data, 'train')
-dir_save_val = os.path.join(dir_data, 'val')
-dir_save_test = os.path.join(dir_data, 'test')
+    for path in [path_label, path_input]:
+        st = os.stat(path)
+        signature[os.path.basename(path)] = [st.st_size, st.st_mtime_ns]
 
-if not os.path.exists(dir_save_train):
-    os.makedirs(dir_save_train)
+    return signature
 
-if not os.path.exists(dir_save_val):
-    os.makedirs(dir_save_val)
+## conversion
+def convert(args):
+    dir_data = args.data_dir
+    path_label = os.path.join(dir_data, args.name_label)
+    path_input = os.path.join(dir_data, args.name_input)
 
-if not os.path.exists(dir_save_test):
-    os.makedirs(dir_save_test)
+    open_tif(path_label, path_input)
 
+    nframe = img_label.n_frames
+    sz = load_frame(0)[0].shape
 
-##
-id_frame = np.arange(nframe)
-np.random.shuffle(id_frame)
+    lst_split = ['train', 'val', 'test']
+    lst_id_frame = split_frame(nframe, ratio=args.ratio, seed=args.seed)
 
-##
-offset_nframe = 0
-for i in range(nframe_train):
-    img_label.seek(id_frame[i + offset_nframe])
-    img_input.seek(id_frame[i + offset_nframe])
+    # resume only when the source files and split settings are unchanged
+    path_signature = os.path.join(dir_data, 'data_load.json')
+    signature = get_signature(path_label, path_input, args)
 
-    label_ = np.asarray(img_label)
-    input_ = np.asarray(img_input)
+    resume = False
+    if os.path.exists(path_signature):
+        with open(path_signature, 'r') as f:
+            resume = json.load(f) == signature
 
-    np.save(os.path.join(dir_save_train, 'label_%03d.npy' % i), label_)
-    np.save(os.path.join(dir_save_train, 'input_%03d.npy' % i), input_)
+    with open(path_signature, 'w') as f:
+        json.dump(signature, f)
 
-##
-offset_nframe += nframe_train
-for i in range(nframe_val):
-    img_label.seek(id_frame[i + offset_nframe])
-    img_input.seek(id_frame[i + offset_nframe])
+    writer = {}
+    tasks = []
 
-    label_ = np.asarray(img_label)
-    input_ = np.asarray(img_input)
+    for split, id_frame in zip(lst_split, lst_id_frame):
+        dir_save = os.path.join(dir_data, split)
 
-    np.save(os.path.join(dir_save_val, 'label_%03d.npy' % i), label_)
-    np.save(os.path.join(dir_save_val, 'input_%03d.npy' % i), input_)
+        if args.save_format == 'shard':
+            writer[split] = ShardWriter(dir_save + '.shard', len(id_frame), sz, resume=resume)
+        elif not os.path.exists(dir_save):
+            os.makedirs(dir_save)
+        elif not resume:
+            clear_split(dir_save)
 
-##
-offset_nframe += nframe_val
-for i in range(nframe_test):
-    img_label.seek(id_frame[i + offset_nframe])
-    img_input.seek(id_frame[i + offset_nframe])
+        for i, id in enumerate(id_frame):
+            if resume:
+                if args.save_format == 'shard':
+                    if writer[split].done(i):
+                        continue
+                elif os.path.exists(os.path.join(dir_save, 'label_%03d.npy' % i)) and \
+                        os.path.exists(os.path.join(dir_save, 'input_%03d.npy' % i)):
+                    continue
+
+            tasks.append((split, i, int(id)))
+
+    print("CONVERT: %d / %d frames (%d already converted)" % (len(tasks), nframe, nframe - len(tasks)))
+
+    # at most 2 frames per worker are decoded but not yet written
+    num_workers = max(1, args.num_workers)
+    max_pending = 2 * num_workers
+
+    with ProcessPoolExecutor(max_workers=num_workers, initializer=open_tif,
+                             initargs=(path_label, path_input)) as executor:
+        pending = set()
+        tasks = iter(tasks)
 
-    label_ = np.asarray(img_label)
-    input_ = np.asarray(img_input)
+        while True:
+            for task in tasks:
+                pending.add(executor.submit(convert_frame, task))
+                if len(pending) >= max_pending:
+                    break
 
-    np.save(os.path.join(dir_save_test, 'label_%03d.npy' % i), label_)
-    np.save(os.path.join(dir_save_test, 'input_%03d.npy' % i), input_)
+            if not pending:
+                break
+
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+            for future in finished:
+                split, i, label_, input_ = future.result()
+
+                if args.save_format == 'shard':
+                    writer[split].write(i, label_, input_)
+                else:
+                    dir_save = os.path.join(dir_data, split)
+                    save_npy(os.path.join(dir_save, 'label_%03d.npy' % i), label_)
+                    save_npy(os.path.join(dir_save, 'input_%03d.npy' % i), input_)
+
+    for split in writer:
+        writer[split].close()
+
+    return lst_id_frame
 
 ##
-plt.subplot(121)
-plt.imshow(label_, cmap = 'gray')
-plt.title('label')
+if __name__ == "__main__":
+    args = parser.parse_args()
+
+    lst_id_frame = convert(args)
+
+    if args.show == "on" and len(lst_id_frame[-1]) > 0:
+        label_, input_ = load_frame(int(lst_id_frame[-1][-1]))
+
+        plt.subplot(121)
+        plt.imshow(label_, cmap = 'gray')
+        plt.title('label')
 
-plt.subplot(122)
-plt.imshow(input_, cmap='gray')
-plt.title('input')
+        plt.subplot(122)
+        plt.imshow(input_, cmap='gray')
+        plt.title('input')
 
-plt.show()
\ No newline at end of file
+        plt.show()
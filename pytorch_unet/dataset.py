@@ -1,34 +1,101 @@
 import os
 import numpy as np
+from collections import OrderedDict
+from PIL import Image
 import torch
 import torch.nn as nn
+from util import *
 
 ## data loader
 class Dataset(torch.utils.data.Dataset):
-    def __init__(self, data_dir, transform=None):
+    def __init__(self, data_dir, transform=None, mmap=False, manifest=False, uint8=False):
         self.data_dir = data_dir
         self.transform = transform
+        self.mmap = mmap
+        self.uint8 = uint8
+        self.mmap_data = {}
 
-        lst_data = os.listdir(self.data_dir)
+        if manifest:
+            # sorted file list from manifest.npz, no directory listing
+            self.manifest = load_manifest(self.data_dir, lambda f: f.startswith(('label', 'input')))
 
-        lst_label = [f for f in lst_data if f.startswith('label')]
-        lst_input = [f for f in lst_data if f.startswith('input')]
+            lst_data = self.manifest['name']
 
-        lst_label.sort()
-        lst_input.sort()
+            lst_label = lst_data[np.char.startswith(lst_data, 'label')]
+            lst_input = lst_data[np.char.startswith(lst_data, 'input')]
+        else:
+            lst_data = os.listdir(self.data_dir)
 
-        self.lst_label = lst_label
-        self.lst_input = lst_input
+            lst_label = [f for f in lst_data if f.startswith('label')]
+            lst_input = [f for f in lst_data if f.startswith('input')]
+
+            lst_label.sort()
+            lst_input.sort()
+
+        self.share(lst_label=np.array(lst_label, dtype=str), lst_input=np.array(lst_input, dtype=str))
 
     def __len__(self):
         return len(self.lst_label)
 
+    def share(self, **arrays):
+        # index arrays live in shared memory (SharedStore), the attributes are views into it
+        self.store = SharedStore(arrays)
+        self.__dict__.update(self.store.arrays)
+
+    def __getstate__(self):
+        # memmaps would be pickled as full copies, so each worker reopens them
+        state = self.__dict__.copy()
+        state['mmap_data'] = {}
+
+        # shared views are attached again from the store
+        for key in self.store.arrays:
+            del state[key]
+
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__dict__.update(self.store.arrays)
+
+    def load(self, name):
+        if not self.mmap:
+            return np.load(os.path.join(self.data_dir, name))
+
+        # map each file once and keep handing out read-only views
+        if name not in self.mmap_data:
+            self.mmap_data[name] = np.load(os.path.join(self.data_dir, name), mmap_mode='r')
+
+        return self.mmap_data[name]
+
+    def read(self, index):
+        label = self.load(self.lst_label[index])
+        input = self.load(self.lst_input[index])
+
+        return label, input
+
     def __getitem__(self, index):
-        label = np.load(os.path.join(self.data_dir, self.lst_label[index]))
-        input = np.load(os.path.join(self.data_dir, self.lst_input[index]))
+        if isinstance(index, tuple):
+            # (frame, top, left, ny, nx) from PatchSampler: only the patch is converted,
+            # and with mmap/shard only its rows are paged in
+            index, top, left, ny, nx = index
+
+            label, input = self.read(index)
 
-        label = label/255.0
-        input = input/255.0
+            label = label[top:top + ny, left:left + nx]
+            input = input[top:top + ny, left:left + nx]
+        else:
+            label, input = self.read(index)
+
+        # uint8: frames stay uint8 and are scaled on the device (to_float)
+        if self.uint8:
+            pass
+        elif self.mmap:
+            # single float32 copy out of the page cache
+            label = np.divide(label, 255.0, dtype=np.float32)
+            input = np.divide(input, 255.0, dtype=np.float32)
+        else:
+            label = label/255.0
+            input = input/255.0
 
         if label.ndim == 2:
             label = label[:, :, np.newaxis]
@@ -43,13 +110,182 @@ class Dataset(torch.utils.data.Dataset):
         return data
 
 
+## packed shard loader (one file per split, random access by offset)
+class ShardDataset(Dataset):
+    def __init__(self, shard_path, transform=None, uint8=False):
+        self.shard_path = shard_path
+        self.transform = transform
+        self.mmap = True
+        self.uint8 = uint8
+        self.mmap_data = {}
+
+        self.share(index=load_shard(self.shard_path))
+
+    def __len__(self):
+        return len(self.index)
+
+    def read(self, index):
+        if 'shard' not in self.mmap_data:
+            self.mmap_data['shard'] = np.memmap(self.shard_path, dtype=np.uint8, mode='r')
+
+        offset, ny, nx, nch = [int(v) for v in self.index[index]]
+        nbyte = ny * nx * nch
+
+        frame = self.mmap_data['shard'][offset:offset + 2 * nbyte]
+
+        label = frame[:nbyte].reshape(ny, nx, nch)
+        input = frame[nbyte:].reshape(ny, nx, nch)
+
+        return label, input
+
+
+## multi-page tif loader (trains straight from the ISBI volumes)
+class TiffDataset(Dataset):
+    def __init__(self, data_dir, split='train', transform=None, ratio=(0.8, 0.1, 0.1), seed=0,
+                 cache_size=256 * 1024 ** 2, name_label='train-labels.tif', name_input='train-volume.tif', uint8=False):
+        self.path_label = os.path.join(data_dir, name_label)
+        self.path_input = os.path.join(data_dir, name_input)
+        self.transform = transform
+        self.mmap = False
+        self.uint8 = uint8
+        self.cache_size = cache_size
+
+        # same split as data_load.py for the same ratio and seed
+        nframe = Image.open(self.path_label).n_frames
+        lst_id_frame = split_frame(nframe, ratio=ratio, seed=seed)
+
+        self.share(id_frame=np.asarray(lst_id_frame[['train', 'val', 'test'].index(split)], dtype=np.int64))
+
+        self.reset()
+
+    def reset(self):
+        self.pid = None
+        self.img_label = None
+        self.img_input = None
+
+        self.cache = OrderedDict()
+        self.cache_nbyte = 0
+
+    def __len__(self):
+        return len(self.id_frame)
+
+    def __getstate__(self):
+        # open file handles and decoded pages stay private to each worker
+        state = super().__getstate__()
+        state.update(pid=None, img_label=None, img_input=None, cache=OrderedDict(), cache_nbyte=0)
+        return state
+
+    def read(self, index):
+        # a forked worker must not share the parent's file offsets
+        if self.pid != os.getpid():
+            self.reset()
+            self.pid = os.getpid()
+            self.img_label = Image.open(self.path_label)
+            self.img_input = Image.open(self.path_input)
+
+        id = int(self.id_frame[index])
+
+        if id in self.cache:
+            self.cache.move_to_end(id)
+            return self.cache[id]
+
+        self.img_label.seek(id)
+        self.img_input.seek(id)
+
+        label = np.asarray(self.img_label)
+        input = np.asarray(self.img_input)
+
+        # least recently used pages are evicted once the byte budget is exceeded
+        self.cache[id] = (label, input)
+        self.cache_nbyte += label.nbytes + input.nbytes
+
+        while self.cache_nbyte > self.cache_size and len(self.cache) > 1:
+            label_, input_ = self.cache.popitem(last=False)[1]
+            self.cache_nbyte -= label_.nbytes + input_.nbytes
+
+        return label, input
+
+
+## patch sampler (tiles over every frame instead of one whole frame per sample)
+class PatchSampler(torch.utils.data.Sampler):
+    # the index holds every valid (frame, top, left) on a grid with the given stride
+    # and the foreground fraction (label > 0) of each patch, from an integral image.
+    # shuffle: patches are drawn with weight 1 + fg_weight * foreground fraction,
+    # otherwise the grid is walked in order. Batches are counted in patches.
+    def __init__(self, dataset, shape, stride=None, fg_weight=0.0, shuffle=True, num_samples=None):
+        self.shape = shape
+        self.stride = stride if stride is not None else shape
+        self.fg_weight = fg_weight
+        self.shuffle = shuffle
+
+        self.index = self.build(dataset)
+        self.weight = 1.0 + fg_weight * self.index['fg']
+
+        self.num_samples = num_samples if num_samples is not None else len(self.index)
+
+    def build(self, dataset):
+        ny, nx = self.shape
+        sy, sx = self.stride
+
+        lst = []
+
+        for i in range(len(dataset)):
+            label, _ = dataset.read(i)
+
+            fg = (label > 0).reshape(label.shape[0], label.shape[1], -1).mean(axis=2)
+            h, w = fg.shape
+
+            if h < ny or w < nx:
+                continue
+
+            # the last row/column of patches is aligned to the border
+            top = np.unique(np.append(np.arange(0, h - ny + 1, sy), h - ny))[:, np.newaxis]
+            left = np.unique(np.append(np.arange(0, w - nx + 1, sx), w - nx))[np.newaxis, :]
+
+            sat = np.pad(fg.cumsum(axis=0).cumsum(axis=1), ((1, 0), (1, 0)))
+            frac = (sat[top + ny, left + nx] - sat[top, left + nx] - sat[top + ny, left] + sat[top, left]) / (ny * nx)
+
+            top, left = np.broadcast_arrays(top, left)
+
+            item = np.zeros(frac.size, dtype=[('frame', '<i8'), ('top', '<i8'), ('left', '<i8'), ('fg', '<f8')])
+            item['frame'] = i
+            item['top'] = top.ravel()
+            item['left'] = left.ravel()
+            item['fg'] = frac.ravel()
+
+            lst += [item]
+
+        if not lst:
+            raise ValueError("no frame is larger than the patch %s" % (self.shape,))
+
+        return np.concatenate(lst)
+
+    def __len__(self):
+        return self.num_samples
+
+    def __iter__(self):
+        if not self.shuffle:
+            order = np.arange(len(self.index))[:self.num_samples]
+        elif self.fg_weight == 0 and self.num_samples <= len(self.index):
+            order = torch.randperm(len(self.index))[:self.num_samples].numpy()
+        else:
+            order = torch.multinomial(torch.from_numpy(self.weight), self.num_samples, replacement=True).numpy()
+
+        ny, nx = self.shape
+
+        for k in order:
+            frame, top, left, _ = self.index[k]
+            yield int(frame), int(top), int(left), ny, nx
+
+
 ## transform (data to tensor)
 class ToTensor(object):
     def __call__(self, data):
         label, input = data['label'], data['input']
 
-        label = label.transpose((2, 0, 1)).astype(np.float32)
-        input = input.transpose((2, 0, 1)).astype(np.float32)
+        # uint8 frames are copied as uint8 (also out of read-only memmaps)
+        label = label.transpose((2, 0, 1)).astype(np.uint8 if label.dtype == np.uint8 else np.float32)
+        input = input.transpose((2, 0, 1)).astype(np.uint8 if input.dtype == np.uint8 else np.float32)
 
         data = {'label' : torch.from_numpy(label), 'input': torch.from_numpy(input)}
 
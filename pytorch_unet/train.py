@@ -27,6 +27,22 @@ parser.add_argument("--log_dir", default="./log", type=str, dest="log_dir")
 parser.add_argument("--result_dir", default="./results", type=str, dest="result_dir")
 parser.add_argument("--mode", default="train", type=str, dest="mode")
 parser.add_argument("--train_continue", default="off", type=str, dest="train_continue")
+parser.add_argument("--manifest", default="off", type=str, dest="manifest")
+parser.add_argument("--mmap", default="off", type=str, dest="mmap")
+parser.add_argument("--data_format", default="npy", choices=["npy", "shard", "tiff"], type=str, dest="data_format")
+parser.add_argument("--ratio", nargs=3, default=[0.8, 0.1, 0.1], type=float, dest="ratio")
+parser.add_argument("--seed", default=0, type=int, dest="seed")
+parser.add_argument("--cache_size", default=256, type=int, dest="cache_size")
+parser.add_argument("--uint8", default="off", type=str, dest="uint8")
+parser.add_argument("--prefetch", default="on", type=str, dest="prefetch")
+parser.add_argument("--precision", default="fp32", choices=["fp32", "bf16", "fp16"], type=str, dest="precision")
+parser.add_argument("--compile", default="off", choices=["off", "on", "script"], type=str, dest="compile")
+parser.add_argument("--channels_last", default="off", type=str, dest="channels_last")
+parser.add_argument("--fuse", default="off", choices=["off", "on", "relu"], type=str, dest="fuse")
+parser.add_argument("--num_workers", default="auto", type=str, dest="num_workers")
+parser.add_argument("--patch", nargs=2, default=None, type=int, dest="patch")
+parser.add_argument("--patch_stride", nargs=2, default=None, type=int, dest="patch_stride")
+parser.add_argument("--fg_weight", default=0.0, type=float, dest="fg_weight")
 
 args = parser.parse_args()
 ## hyperparameter
@@ -36,41 +52,103 @@ batch_size = args.batch_size
 num_epoch = args.num_epoch
 
 data_dir = args.data_dir
-ckpt_dir = args.ckpt_dr
+ckpt_dir = args.ckpt_dir
 log_dir = args.log_dir
 result_dir = args.result_dir
 
 mode = args.mode
 train_continue = args.train_continue
+manifest = args.manifest == "on"
+mmap = args.mmap == "on"
+data_format = args.data_format
+ratio = args.ratio
+seed = args.seed
+cache_size = args.cache_size * 1024 ** 2
+uint8 = args.uint8 == "on"
+prefetch = args.prefetch == "on"
+precision = args.precision
+compile_mode = args.compile
+channels_last = args.channels_last == "on"
+fuse = args.fuse
+num_workers = args.num_workers
+patch = args.patch
+patch_stride = args.patch_stride
+fg_weight = args.fg_weight
 
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+memory_format = torch.channels_last if channels_last else torch.contiguous_format
+
+fn_prefetch = lambda loader: DevicePrefetcher(loader, device) if prefetch else loader
+
+def fn_loader(dataset, shuffle, sampler=None):
+    kwargs = dict(batch_size=batch_size, shuffle=shuffle and sampler is None, sampler=sampler,
+                  pin_memory=prefetch and device.type == 'cuda')
+
+    if num_workers == "auto":
+        return LoaderTuner(dataset, **kwargs)
+    else:
+        return DataLoader(dataset, num_workers=int(num_workers), **kwargs)
+
 ## make dir
 if not os.path.exists(result_dir):
     os.makedirs(os.path.join(result_dir, 'png'))
     os.makedirs(os.path.join(result_dir, 'numpy'))
 
 ## transfrom and data loading
-transform = transforms.Compose([Normalization(mean=0.5, std=0.5), RandomFlip(), ToTensor()])
+# --uint8 on: frames leave the workers as uint8, input normalization runs on the device (to_float)
+if uint8:
+    transform = transforms.Compose([RandomFlip(), ToTensor()])
+else:
+    transform = transforms.Compose([Normalization(mean=0.5, std=0.5), RandomFlip(), ToTensor()])
 
 #순서대로 일어남
 if mode == "train":
-    dataset_train = Dataset(data_dir=os.path.join(data_dir, 'train'), transform=transform)
-    loader_train = DataLoader(dataset_train, batch_size=batch_size, shuffle=True, num_workers=8)
-
-    dataset_val = Dataset(data_dir=os.path.join(data_dir, 'val'), transform=transform)
-    loader_val = DataLoader(dataset_val, batch_size=batch_size, shuffle=True, num_workers=8)
+    if data_format == "shard":
+        dataset_train = ShardDataset(shard_path=os.path.join(data_dir, 'train.shard'), transform=transform, uint8=uint8)
+    elif data_format == "tiff":
+        dataset_train = TiffDataset(data_dir=data_dir, split='train', transform=transform,
+                                    ratio=ratio, seed=seed, cache_size=cache_size, uint8=uint8)
+    else:
+        dataset_train = Dataset(data_dir=os.path.join(data_dir, 'train'), transform=transform, mmap=mmap, manifest=manifest, uint8=uint8)
+
+    # --patch ny nx: batches of patches (PatchSampler) instead of whole frames
+    sampler_train = PatchSampler(dataset_train, shape=patch, stride=patch_stride, fg_weight=fg_weight) if patch else None
+    loader_train = fn_loader(dataset_train, shuffle=True, sampler=sampler_train)
+    if num_workers == "auto":
+        loader_train.calibrate()
+
+    if data_format == "shard":
+        dataset_val = ShardDataset(shard_path=os.path.join(data_dir, 'val.shard'), transform=transform, uint8=uint8)
+    elif data_format == "tiff":
+        dataset_val = TiffDataset(data_dir=data_dir, split='val', transform=transform,
+                                  ratio=ratio, seed=seed, cache_size=cache_size, uint8=uint8)
+    else:
+        dataset_val = Dataset(data_dir=os.path.join(data_dir, 'val'), transform=transform, mmap=mmap, manifest=manifest, uint8=uint8)
+
+    sampler_val = PatchSampler(dataset_val, shape=patch, stride=patch_stride, shuffle=False) if patch else None
+    loader_val = fn_loader(dataset_val, shuffle=True, sampler=sampler_val)
 
     ##variables
-    num_data_train = len(dataset_train)
-    num_data_val = len(dataset_val)
+    num_data_train = len(sampler_train) if patch else len(dataset_train)
+    num_data_val = len(sampler_val) if patch else len(dataset_val)
 
     num_batch_train = np.ceil(num_data_train / batch_size)
     num_batch_val = np.ceil(num_data_val / batch_size)
 else:
-    transform = transforms.Compose([Normalization(mean=0.5, std=0.5), ToTensor()])
-
-    dataset_test = Dataset(data_dir=os.path.join(data_dir, 'test'), transform=transform)
-    loader_test = DataLoader(dataset_test, batch_size=batch_size, shuffle=False, num_workers=8)
+    if uint8:
+        transform = transforms.Compose([ToTensor()])
+    else:
+        transform = transforms.Compose([Normalization(mean=0.5, std=0.5), ToTensor()])
+
+    if data_format == "shard":
+        dataset_test = ShardDataset(shard_path=os.path.join(data_dir, 'test.shard'), transform=transform, uint8=uint8)
+    elif data_format == "tiff":
+        dataset_test = TiffDataset(data_dir=data_dir, split='test', transform=transform,
+                                   ratio=ratio, seed=seed, cache_size=cache_size, uint8=uint8)
+    else:
+        dataset_test = Dataset(data_dir=os.path.join(data_dir, 'test'), transform=transform, mmap=mmap, manifest=manifest, uint8=uint8)
+    loader_test = fn_loader(dataset_test, shuffle=False)
 
     num_data_test = len(dataset_test)
     num_batch_test = np.ceil(num_data_test / batch_size)
@@ -78,12 +156,26 @@ else:
 ## making network
 net = UNet().to(device)
 
+net = net.to(memory_format=memory_format)
+
 ## loss function
 fn_loss = nn.BCEWithLogitsLoss().to(device)
 
 ## optimizer
 optim = torch.optim.Adam(net.parameters(), lr=lr)
 
+## mixed precision
+amp = Precision(precision, device)
+
+fn_net = net
+
+fn_sample = lambda shape: torch.randn(shape, device=device).contiguous(memory_format=memory_format)
+
+# fixed batch shape the network is compiled for
+def fn_shape(dataset):
+    shape = dataset[0]['input'].shape
+    return (batch_size, shape[0]) + (tuple(patch) if patch else tuple(shape[1:]))
+
 ## output functions
 fn_tonumpy = lambda x: x.to('cpu').detach().numpy().transpose(0, 2, 3, 1)
 fn_denorm = lambda x, mean, std: (x * std) + mean
@@ -102,24 +194,29 @@ if mode =="train": #TRAIN
     if train_continue == "on":
         net, optim, st_epoch = load(ckpt_dir=ckpt_dir, net=net, optim=optim)
 
+    if compile_mode != "off":
+        fn_net = compile_net(net, compile_mode, fn_shape(dataset_train), device, train=True, amp=amp, memory_format=memory_format)
+
     for epoch in range(st_epoch + 1, num_epoch + 1):
-        net.train()
+        fn_net.train()
         loss_arr = []
 
-        for batch, data in enumerate(loader_train, 1):
+        for batch, data in enumerate(fn_prefetch(loader_train), 1):
             # forward pass
-            label = data['label'].to(device)
-            input = data['input'].to(device)
+            label = to_float(data['label'].to(device), memory_format=memory_format)
+            input = to_float(data['input'].to(device), mean=0.5, std=0.5, memory_format=memory_format)
 
-            output = net(input)
+            with amp.autocast():
+                output = fn_net(input)
+                loss = fn_loss(output, label)
 
             # backward pass
             optim.zero_grad()
 
-            loss = fn_loss(output, label)
-            loss.backward()
+            amp.step(loss, optim)
 
-            optim.step()
+            # bf16/fp16 outputs are written out in fp32
+            output = output.float()
 
             # loss function
             loss_arr += [loss.item()]
@@ -138,19 +235,27 @@ if mode =="train": #TRAIN
 
         writer_train.add_scalar('loss', np.mean(loss_arr), epoch)
 
+    fn_net_val = fn_net
+
+    if fuse != "off":
+        fn_net_val = fuse_for_inference(net, fn_sample(fn_shape(dataset_val)), relu=fuse == "relu")
+
     with torch.no_grad():
-        net.eval()
+        fn_net_val.eval()
         loss_arr = []
 
-        for batch, data in enumerate(loader_val, 1):
+        for batch, data in enumerate(fn_prefetch(loader_val), 1):
             # forward pass
-            label = data['label'].to(device)
-            input = data['input'].to(device)
+            label = to_float(data['label'].to(device), memory_format=memory_format)
+            input = to_float(data['input'].to(device), mean=0.5, std=0.5, memory_format=memory_format)
 
-            output = net(input)
+            with amp.autocast():
+                output = fn_net_val(input)
 
-            # loss function
-            loss = fn_loss(output, label)
+                # loss function
+                loss = fn_loss(output, label)
+
+            output = output.float()
 
             loss_arr += [loss.item()]
 
@@ -158,7 +263,7 @@ if mode =="train": #TRAIN
                   (epoch, num_epoch, batch, num_batch_train, np.mean(loss_arr)))
 
             label = fn_tonumpy(label)
-            input = fn_tonumpy(fn_denorm(input))
+            input = fn_tonumpy(fn_denorm(input, mean=0.5, std=0.5))
             output = fn_tonumpy(fn_class(output))
 
             writer_val.add_image('label', label, num_batch_train * (epoch - 1) + batch, dataformats='NHWC')
@@ -176,19 +281,28 @@ if mode =="train": #TRAIN
 else: #TEST
     net, optim, st_epoch = load(ckpt_dir=ckpt_dir, net=net, optim=optim)
 
+    if fuse != "off":
+        fn_net = fuse_for_inference(net, fn_sample(fn_shape(dataset_test)), relu=fuse == "relu")
+
+    if compile_mode != "off":
+        fn_net = compile_net(fn_net.eval(), compile_mode, fn_shape(dataset_test), device, train=False, amp=amp, memory_format=memory_format)
+
     with torch.no_grad():
-        net.eval()
+        fn_net.eval()
         loss_arr = []
 
-        for batch, data in enumerate(loader_test, 1):
+        for batch, data in enumerate(fn_prefetch(loader_test), 1):
             # forward pass
-            label = data['label'].to(device)
-            input = data['input'].to(device)
+            label = to_float(data['label'].to(device), memory_format=memory_format)
+            input = to_float(data['input'].to(device), mean=0.5, std=0.5, memory_format=memory_format)
 
-            output = net(input)
+            with amp.autocast():
+                output = fn_net(input)
 
-            # loss function
-            loss = fn_loss(output, label)
+                # loss function
+                loss = fn_loss(output, label)
+
+            output = output.float()
 
             loss_arr += [loss.item()]
 
@@ -196,7 +310,7 @@ else: #TEST
                   (batch, num_batch_test, np.mean(loss_arr)))
 
             label = fn_tonumpy(label)
-            input = fn_tonumpy(fn_denorm(input))
+            input = fn_tonumpy(fn_denorm(input, mean=0.5, std=0.5))
             output = fn_tonumpy(fn_class(output))
 
             for j in range(label.shape[0]):
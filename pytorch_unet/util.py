@@ -1,9 +1,14 @@
 
 import os
+import sys
 import numpy as np
 import torch
 import torch.nn as nn
 
+## loader, device and runtime helpers shared by the three projects (../common/runtime.py)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from common.runtime import *
+
 ## network saving
 def save(ckpt_dir, net, optim, epoch):
     if not os.path.exists(ckpt_dir):
@@ -27,3 +32,119 @@ def load(ckpt_dir, net, optim):
     epoch = int(ckpt_lst[-1].split('epoch')[1].split('pth')[0])
 
     return net, optim, epoch
+
+## train/val/test split
+def split_frame(nframe, ratio=(0.8, 0.1, 0.1), seed=0):
+    ratio = np.asarray(ratio, dtype=np.float64)
+    ratio = ratio / ratio.sum()
+
+    nframe_split = np.floor(ratio * nframe).astype(np.int64)
+    nframe_split[0] += nframe - nframe_split.sum()
+
+    id_frame = np.random.RandomState(seed).permutation(nframe)
+
+    return np.split(id_frame, np.cumsum(nframe_split)[:-1])
+
+## packed shard
+# header | index | frames, one shard per split.
+# each frame record holds the label bytes followed by the input bytes (uint8).
+SHARD_MAGIC = b'DSLSHARD'
+SHARD_VERSION = 1
+SHARD_ALIGN = 64
+
+SHARD_HEADER = np.dtype([('magic', 'S8'), ('version', '<u4'), ('nframe', '<u4')])
+SHARD_INDEX = np.dtype([('offset', '<u8'), ('ny', '<u4'), ('nx', '<u4'), ('nch', '<u4')])
+
+class ShardWriter(object):
+    # frames are written at fixed offsets, so they may arrive in any order.
+    # an index entry is only filled in after its frame, which lets an
+    # interrupted conversion resume from the frames already on disk.
+    def __init__(self, path, nframe, sz, resume=False):
+        self.path = path
+        self.nframe = nframe
+        self.sz = tuple(sz) + (1,) * (3 - len(sz))
+
+        nbyte = int(np.prod(self.sz))
+        self.base = -(-(SHARD_HEADER.itemsize + SHARD_INDEX.itemsize * nframe) // SHARD_ALIGN) * SHARD_ALIGN
+        self.stride = -(-2 * nbyte // SHARD_ALIGN) * SHARD_ALIGN
+
+        self.index = np.zeros(nframe, dtype=SHARD_INDEX)
+
+        if resume and os.path.exists(path):
+            try:
+                index = load_shard(path, complete=False)
+            except ValueError:
+                index = None
+
+            if index is not None and len(index) == nframe:
+                self.index = index
+                self.file = open(path, 'r+b')
+                return
+
+        header = np.zeros(1, dtype=SHARD_HEADER)
+        header['magic'] = SHARD_MAGIC
+        header['version'] = SHARD_VERSION
+        header['nframe'] = nframe
+
+        self.file = open(path, 'w+b')
+        self.file.write(header.tobytes())
+        self.file.write(self.index.tobytes())
+        self.file.truncate(self.base + self.stride * nframe)
+
+    def done(self, i):
+        return self.index[i]['offset'] != 0
+
+    def write(self, i, label, input):
+        # every slot holds one uint8 label and one uint8 input of the shard frame size;
+        # anything else would overrun the slot or be wrapped by the uint8 cast
+        for name, value in [('label', label), ('input', input)]:
+            sz = tuple(value.shape) + (1,) * (3 - value.ndim)
+
+            if sz != self.sz:
+                raise ValueError("ShardWriter: %s of frame %d has shape %s, expected %s" % (name, i, value.shape, self.sz))
+            if value.dtype != np.uint8:
+                raise ValueError("ShardWriter: %s of frame %d is %s, expected uint8" % (name, i, value.dtype))
+
+        offset = self.base + self.stride * i
+
+        self.file.seek(offset)
+        self.file.write(np.ascontiguousarray(label).tobytes())
+        self.file.write(np.ascontiguousarray(input).tobytes())
+
+        self.index[i] = (offset,) + self.sz
+        self.file.seek(SHARD_HEADER.itemsize + SHARD_INDEX.itemsize * i)
+        self.file.write(self.index[i:i + 1].tobytes())
+
+    def close(self):
+        self.file.close()
+
+def save_shard(path, lst_label, lst_input):
+    writer = ShardWriter(path, len(lst_label), lst_label[0].shape)
+
+    for i in range(len(lst_label)):
+        writer.write(i, lst_label[i], lst_input[i])
+
+    writer.close()
+
+# complete: every frame must have been written (offset 0 marks a slot of an interrupted conversion)
+def load_shard(path, complete=True):
+    header = np.fromfile(path, dtype=SHARD_HEADER, count=1)
+
+    if len(header) == 0 or header[0]['magic'] != SHARD_MAGIC or header[0]['version'] != SHARD_VERSION:
+        raise ValueError("%s is not a version %d shard" % (path, SHARD_VERSION))
+
+    header = header[0]
+
+    index = np.fromfile(path, dtype=SHARD_INDEX, count=header['nframe'], offset=SHARD_HEADER.itemsize)
+
+    if len(index) != header['nframe']:
+        raise ValueError("%s: index holds %d of %d frames" % (path, len(index), header['nframe']))
+
+    missing = np.flatnonzero(index['offset'] == 0)
+
+    if complete and len(missing):
+        raise ValueError("%s: %d of %d frames were never written (first: %d), the conversion was interrupted; "
+                         "run data_load.py --save_format shard again with the same settings to resume it"
+                         % (path, len(missing), len(index), missing[0]))
+
+    return index
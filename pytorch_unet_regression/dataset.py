@@ -1,56 +1,233 @@
 import os
+import zlib
+import hashlib
 import numpy as np
 import torch
 import torch.nn as nn
 import matplotlib.pyplot as plt
+import multiprocessing as mp
 from util import *
+
+## decoded image cache shared by the DataLoader workers
+class SharedImageCache(object):
+    # images are appended to one shared uint8 block until the byte budget is used up.
+    # meta[index] = (offset, ny, nx, nch), offset -1: not cached, -2: being written
+    def __init__(self, num_data, cache_size):
+        self.num_data = num_data
+        self.cache_size = cache_size
+
+        self.store = SharedStore({'top': np.zeros(1, dtype=np.int64), 'meta': np.full((num_data, 4), -1, dtype=np.int64)},
+                                 empty={'data': ((cache_size,), np.uint8)})
+        self.lock = mp.Lock()
+
+    def get(self, index):
+        offset, ny, nx, nch = self.store['meta'][index]
+
+        if offset < 0:
+            return None
+
+        img = self.store['data'][offset:offset + ny * nx * nch].reshape(ny, nx, nch)
+        img.setflags(write=False)
+
+        return img
+
+    def put(self, index, img):
+        top = self.store['top']
+        meta = self.store['meta']
+
+        with self.lock:
+            if meta[index, 0] != -1 or top[0] + img.nbytes > self.cache_size:
+                return
+
+            offset = top[0]
+            top[0] += img.nbytes
+            meta[index, 0] = -2
+
+        self.store['data'][offset:offset + img.nbytes] = img.ravel()
+
+        # the offset is published last, so readers never see a half written image
+        meta[index, 1:] = img.shape
+        meta[index, 0] = offset
+
 ## data loader
 class Dataset(torch.utils.data.Dataset):
-    def __init__(self, data_dir, transform=None, task=None, opts=None):
+    def __init__(self, data_dir, transform=None, task=None, opts=None, cache_size=0, manifest=False,
+                 cache_dir=None, seed=None, blur_backend="skimage", uint8=False):
         self.data_dir = data_dir
         self.transform = transform
         self.task = task
         self.opts = opts
 
-        lst_data = os.listdir(self.data_dir)
+        # uint8: png images are quantized to uint8 when read (--uint8 on), otherwise kept as decoded
+        self.uint8 = uint8
 
-        lst_data = [f for f in lst_data if f.endswith('jpg') | f.endswith('png')]
+        # resample backend of add_blur (super resolution), see check_blur
+        self.blur_backend = blur_backend
 
-        lst_data.sort()
+        if manifest:
+            # sorted file list (and image shapes) from manifest.npz, no directory listing
+            self.manifest = load_manifest(self.data_dir, lambda f: f.endswith('jpg') | f.endswith('png'))
 
-        self.lst_label = lst_data
+            lst_data = self.manifest['name']
+        else:
+            lst_data = os.listdir(self.data_dir)
+
+            lst_data = [f for f in lst_data if f.endswith('jpg') | f.endswith('png')]
+
+            lst_data.sort()
+
+        if manifest:
+            self.share(lst_data=np.array(lst_data, dtype=str), manifest=self.manifest)
+        else:
+            self.share(lst_data=np.array(lst_data, dtype=str))
+
+        # seed: same crop and degradation of an image on every pass (val/test)
+        # cache_dir: degraded inputs are generated once and read back from disk
+        self.seed = seed
+        self.cache_dir = cache_dir
+
+        # float32 noise buffers of this worker, by image shape
+        self.buffers = {}
+
+        if self.cache_dir is not None and not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+        # cache_size: byte budget of the shared decoded image cache (0: off)
+        self.cache = SharedImageCache(len(lst_data), cache_size) if cache_size > 0 else None
 
     def __len__(self):
         return len(self.lst_data)
 
-    def __getitem__(self, index):
-        #label = np.load(os.path.join(self.data_dir, self.lst_label[index]))
-        #input = np.load(os.path.join(self.data_dir, self.lst_input[index]))
+    def share(self, **arrays):
+        # index arrays live in shared memory (SharedStore), the attributes are views into it
+        self.store = SharedStore(arrays)
+        self.__dict__.update(self.store.arrays)
+
+    def __getstate__(self):
+        # shared views are attached again from the store, not pickled
+        state = self.__dict__.copy()
 
+        for key in self.store.arrays:
+            del state[key]
+
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__dict__.update(self.store.arrays)
+
+    def reseed(self, index, stage):
+        if self.seed is not None:
+            np.random.seed([self.seed, zlib.crc32(str(self.lst_data[index]).encode()), stage])
+
+    def generator(self, index):
+        # seeded per image (val/test), otherwise the stream of this worker (seed_worker)
+        if self.seed is not None:
+            return np.random.default_rng([self.seed, zlib.crc32(str(self.lst_data[index]).encode()), 2])
+        else:
+            return get_rng()
+
+    def buffer(self, shape):
+        # reused for every sample, which is only safe because FusedTransform copies out of it
+        if not isinstance(self.transform, FusedTransform):
+            return None
+
+        if shape not in self.buffers:
+            self.buffers[shape] = np.empty(shape, dtype=np.float32)
+
+        return self.buffers[shape]
+
+    def cache_path(self, index):
+        # keyed by task, opts, seed and the source file (name, size, mtime)
+        name = str(self.lst_data[index])
+        st = os.stat(os.path.join(self.data_dir, name))
+
+        key = repr((self.task, self.opts[0], np.asarray(self.opts[1]).tolist(), self.blur_backend, self.seed,
+                    name, st.st_size, st.st_mtime_ns))
+
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode()).hexdigest() + '.npy')
+
+    def degrade(self, img, index):
+        if self.cache_dir is not None:
+            path = self.cache_path(index)
+
+            if os.path.exists(path):
+                return np.load(path)
+
+        rng = self.generator(index)
+
+        if self.task =="denoising":
+            input = add_noise(img, type=self.opts[0], opts=self.opts[1], rng=rng, out=self.buffer(img.shape))
+        elif self.task == "inpainting":
+            input = add_sampling(img, type=self.opts[0], opts=self.opts[1], rng=rng)
+        elif self.task == "super resolution":
+            input = add_blur(img, type=self.opts[0], opts=self.opts[1], backend=self.blur_backend)
+
+        if self.cache_dir is not None:
+            input = input.astype(np.float32)
+
+            np.save(path + '.%d.tmp.npy' % os.getpid(), input)
+            os.replace(path + '.%d.tmp.npy' % os.getpid(), path)
+
+        return input
+
+    def read(self, index):
         img = plt.imread(os.path.join(self.data_dir, self.lst_data[index]))
+
+        if img.ndim == 2:
+            img = img[:, :, np.newaxis]
+
         sz = img.shape
 
         if sz[0] > sz[1]:
             img = img.transpose((1, 0, 2))
 
-        if img.dtype == np.uint8:
-            img = img/255.0
+        # png decodes to float in [0, 1]; --uint8 on keeps images as uint8 until the transform
+        if self.uint8 and img.dtype != np.uint8:
+            img = np.round(img * 255.0).astype(np.uint8)
 
+        return img
 
-        if img.ndim == 2:
-            img = img[:, :, np.newaxis]
+    def __getitem__(self, index):
+        if self.seed is None:
+            return self.get(index)
+
+        # the global random state of the worker is left as it was
+        state = np.random.get_state()
+        data = self.get(index)
+        np.random.set_state(state)
+
+        return data
+
+    def get(self, index):
+        #label = np.load(os.path.join(self.data_dir, self.lst_label[index]))
+        #input = np.load(os.path.join(self.data_dir, self.lst_input[index]))
+
+        if self.cache is None:
+            img = self.read(index)
+        else:
+            img = self.cache.get(index)
 
+            if img is None:
+                img = self.read(index)
+
+                # the cache always holds uint8
+                if img.dtype != np.uint8:
+                    img = np.round(img * 255.0).astype(np.uint8)
+
+                self.cache.put(index, np.ascontiguousarray(img))
+
+        # the label keeps its dtype (uint8 images stay uint8) until the transform, only the degradation needs floats
         label = img
 
-        if self.task =="denoising":
-            input = add_noise(img, type=self.opts[0], opts=self.opts[1])
-        elif self.task == "inpainting":
-            input = add_sampling(img, type=self.opts[0], opts=self.opts[1])
-        elif self.taks == "super resolution":
-            input = add_blur(img, type=self.opts[0], opts=self.opts[1])
+        data = {'label': label}
 
-        data = {'input': input, 'label': label}
+        # task=None: only the label is returned and degraded on the device (Degradation)
+        self.reseed(index, 0)
+        if self.task is not None:
+            data['input'] = self.degrade(img/255.0 if img.dtype == np.uint8 else img, index)
 
+        self.reseed(index, 1)
         if self.transform:
             data = self.transform(data)
 
@@ -60,12 +237,16 @@ class Dataset(torch.utils.data.Dataset):
 ## transform (data to tensor)
 class ToTensor(object):
     def __call__(self, data):
-        label, input = data['label'], data['input']
+        for key, value in data.items():
+            # already converted (FusedTransform)
+            if torch.is_tensor(value):
+                continue
 
-        label = label.transpose((2, 0, 1)).astype(np.float32)
-        input = input.transpose((2, 0, 1)).astype(np.float32)
+            if value.dtype == np.uint8:
+                value = value / 255.0
 
-        data = {'label' : torch.from_numpy(label), 'input': torch.from_numpy(input)}
+            value = value.transpose((2, 0, 1)).astype(np.float32)
+            data[key] = torch.from_numpy(value)
 
         return data
 
@@ -75,28 +256,23 @@ class Normalization(object):
         self.std = std
 
     def __call__(self, data):
-        label, input = data['label'], data['input']
-
-        input = (input - self.mean) / self.std
-        label = (label - self.mean) / self.std
+        for key, value in data.items():
+            if value.dtype == np.uint8:
+                value = value / 255.0
 
-        data = {'label': label, 'input': input}
+            data[key] = (value - self.mean) / self.std
 
         return data
 
 class RandomFlip(object):
     def __call__(self, data):
-        label, input = data['label'], data['input']
-
         if np.random.rand() > 0.5:
-            label = np.fliplr(label)
-            input = np.fliplr(input)
+            for key, value in data.items():
+                data[key] = np.fliplr(value)
 
         if np.random.rand() > 0.5:
-            label = np.flipud(label)
-            input = np.flipud(input)
-
-        data = {'label': label, 'input': input}
+            for key, value in data.items():
+                data[key] = np.flipud(value)
 
         return data
 
@@ -104,21 +280,90 @@ class RandomCrop(object):
     def __init__(self, shape):
         self.shape = shape
 
-    def __call__(self, data):
-        input, label = data['input'], data['label']
-        h, w = input.shape[:2]
+    def box(self, shape):
+        h, w = shape[:2]
         new_h, new_w = self.shape
 
-        top = np.random.randint(0, h - new_h)
-        left = np.random.randint(0, w - new_w)
+        top = np.random.randint(h - new_h + 1)
+        left = np.random.randint(w - new_w + 1)
 
-        id_y = np.arange(top, top+new_h, 1)[:, np.newaxis]
-        id_x = np.arange(left, left + new_w, 1)
+        return top, left, new_h, new_w
 
-        input = input[id_y, id_x]
-        label = label[id_y, id_x]
+    def __call__(self, data):
+        top, left, new_h, new_w = self.box(data['label'].shape)
 
-        data = {'input': input, 'label' : label}
+        # slicing views instead of index grids, no copy
+        for key, value in data.items():
+            data[key] = value[top:top + new_h, left:left + new_w]
 
         return data
 
+class FusedTransform(object):
+    # RandomCrop + Normalization + RandomFlip + ToTensor in one pass: the crop and
+    # the flips are views, every key is written once into a float32 CHW tensor
+    # uint8: uint8 images are copied as uint8 tensors and normalized on the device (to_float)
+    def __init__(self, shape=None, mean=0.5, std=0.5, flip=True, uint8=False):
+        self.crop = RandomCrop(shape=shape) if shape is not None else None
+        self.mean = mean
+        self.std = std
+        self.flip = flip
+        self.uint8 = uint8
+
+    def __call__(self, data):
+        if self.crop is not None:
+            top, left, new_h, new_w = self.crop.box(data['label'].shape)
+
+        flip = [self.flip and np.random.rand() > 0.5, self.flip and np.random.rand() > 0.5]
+
+        for key, value in data.items():
+            if self.crop is not None:
+                value = value[top:top + new_h, left:left + new_w]
+            if flip[0]:
+                value = value[:, ::-1]
+            if flip[1]:
+                value = value[::-1]
+
+            if self.uint8 and value.dtype == np.uint8:
+                out = torch.empty((value.shape[2], value.shape[0], value.shape[1]), dtype=torch.uint8)
+                np.copyto(out.numpy(), value.transpose((2, 0, 1)))
+
+                data[key] = out
+                continue
+
+            # uint8 images are scaled to [0, 1] in the same multiply
+            scale = 1 / 255.0 if value.dtype == np.uint8 else 1.0
+
+            out = torch.empty((value.shape[2], value.shape[0], value.shape[1]), dtype=torch.float32)
+            dst = out.numpy()
+
+            np.multiply(value.transpose((2, 0, 1)), scale / self.std, out=dst)
+            np.subtract(dst, self.mean / self.std, out=dst)
+
+            data[key] = out
+
+        return data
+
+## batch degradation on the training device
+# the Dataset is built with task=None so workers only ship clean labels;
+# labels arrive normalized, the degradation itself runs on [0, 1] images
+class Degradation(object):
+    def __init__(self, task, opts, mean=0.5, std=0.5):
+        self.task = task
+        self.opts = opts
+        self.mean = mean
+        self.std = std
+
+    def __call__(self, label):
+        with torch.no_grad():
+            img = label * self.std + self.mean
+
+            if self.task == "denoising":
+                input = add_noise_batch(img, type=self.opts[0], opts=self.opts[1])
+            elif self.task == "inpainting":
+                input = add_sampling_batch(img, type=self.opts[0], opts=self.opts[1])
+            elif self.task == "super resolution":
+                input = add_blur_batch(img, type=self.opts[0], opts=self.opts[1])
+
+            input = (input - self.mean) / self.std
+
+        return input
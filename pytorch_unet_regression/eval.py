@@ -1,4 +1,5 @@
 import os
+import argparse
 import numpy as np
 
 import torch
@@ -9,7 +10,16 @@ from torch.utils.tensorboard import SummaryWriter
 
 from torchvision import transforms, datasets
 
+from util import LoaderTuner, fuse_for_inference
+
 import matplotlib.pyplot as plt
+
+## parser
+parser = argparse.ArgumentParser(description='Test the UNet',
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("--fuse", default="off", choices=["off", "on", "relu"], type=str, dest="fuse")
+args = parser.parse_args()
+
 ## hyperparameter
 
 lr = 1e-3
@@ -20,6 +30,7 @@ data_dir = './datasets'
 ckpt_dir = './checkpoint'
 log_dir = './log'
 result_dir = './results'
+fuse = args.fuse
 
 if not os.path.exists(result_dir):
     os.makedirs(result_dir)
@@ -226,7 +237,8 @@ class RandomFlip(object):
 transform = transforms.Compose([Normalization(mean=0.5, std=0.5), ToTensor()])
 
 dataset_test = Dataset(data_dir=os.path.join(data_dir, 'test'), transform=transform)
-loader_test = DataLoader(dataset_test, batch_size=batch_size, shuffle=False, num_workers=8)
+# worker count from the available cores instead of a fixed 8
+loader_test = LoaderTuner(dataset_test, batch_size=batch_size, shuffle=False)
 
 ## making network
 net = UNet().to(device)
@@ -275,6 +287,10 @@ def load(ckpt_dir, net, optim):
 st_epoch = 0
 net, optim, st_epoch = load(ckpt_dir=ckpt_dir, net=net, optim=optim)
 
+# BatchNorm folded into the convolutions, checked on the first test sample
+if fuse != "off":
+    net = fuse_for_inference(net, dataset_test[0]['input'].unsqueeze(0).to(device), relu=fuse == "relu")
+
 with torch.no_grad():
     net.eval()
     loss_arr = []
@@ -295,7 +311,7 @@ with torch.no_grad():
             (batch, num_batch_test, np.mean(loss_arr)))
 
         label = fn_tonumpy(label)
-        input = fn_tonumpy(fn_denorm(input))
+        input = fn_tonumpy(fn_denorm(input, mean=0.5, std=0.5))
         output = fn_tonumpy(fn_class(output))
 
         for j in range(label.shape[0]):
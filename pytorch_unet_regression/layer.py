@@ -17,8 +17,7 @@ class CBR2d(nn.Module):
         if not relu is None:
             layers += [nn.ReLU() if relu == 0.0 else nn.LeakyReLU(relu)]
 
-        cbr = nn.Sequential(*layers)  # layers를 가변적인 갯수를 가진 위치 인수로 정의
+        self.cbr = nn.Sequential(*layers)  # layers를 가변적인 갯수를 가진 위치 인수로 정의
 
-        return cbr
     def forward(self, x):
         return self.cbr(x)
\ No newline at end of file
@@ -61,7 +61,7 @@ class UNet(nn.Module):
         self.dec1_2 = CBR2d(in_channels=2 * 1*nker, out_channels=1*nker, norm=norm)  # skip connection
         self.dec1_1 = CBR2d(in_channels=1*nker, out_channels=1*nker, norm=norm)
 
-        self.fc = nn.Conv2d(in_channels=1*nker, out_channels=1, kernel_size=1, stride=1, padding=0, bias=True)
+        self.fc = nn.Conv2d(in_channels=1*nker, out_channels=nch, kernel_size=1, stride=1, padding=0, bias=True)
 
     def forward(self, x):
         enc1_1 = self.enc1_1(x)
@@ -113,7 +113,7 @@ class UNet(nn.Module):
 
 class AutoEncoder(nn.Module):
     def __init__(self, nch, nker, norm="bnorm", learning_type="plain"):
-        super(UNet, self).__init__()
+        super(AutoEncoder, self).__init__()
 
         self.learning_type = learning_type
 
@@ -166,7 +166,7 @@ class AutoEncoder(nn.Module):
         self.dec1_2 = CBR2d(in_channels=1*nker, out_channels=1*nker, norm=norm)  # skip connection
         self.dec1_1 = CBR2d(in_channels=1*nker, out_channels=1*nker, norm=norm)
 
-        self.fc = nn.Conv2d(in_channels=1*nker, out_channels=1, kernel_size=1, stride=1, padding=0, bias=True)
+        self.fc = nn.Conv2d(in_channels=1*nker, out_channels=nch, kernel_size=1, stride=1, padding=0, bias=True)
 
     def forward(self, x):
         enc1_1 = self.enc1_1(x)
@@ -27,13 +27,29 @@ parser.add_argument("--log_dir", default="./log", type=str, dest="log_dir")
 parser.add_argument("--result_dir", default="./results", type=str, dest="result_dir")
 parser.add_argument("--mode", default="train", type=str, dest="mode")
 parser.add_argument("--train_continue", default="off", type=str, dest="train_continue")
+parser.add_argument("--manifest", default="off", type=str, dest="manifest")
+parser.add_argument("--cache_size", default=0, type=int, dest="cache_size")
 
 parser.add_argument("--task", default="denoising", choices=["denoising","inpainting","super resolution"], type=str, dest="task")
 parser.add_argument('--opts', nargs="+", default=["random", 30.0], dest="opts")
-
-parser.add_argument("--ny", default=320, type=int, dset="ny")
+parser.add_argument("--degradation", default="worker", choices=["worker", "device"], type=str, dest="degradation")
+parser.add_argument("--blur_backend", default="skimage", choices=["skimage", "matrix", "torch"], type=str, dest="blur_backend")
+parser.add_argument("--eval_cache", default="off", type=str, dest="eval_cache")
+parser.add_argument("--cache_dir", default="./cache", type=str, dest="cache_dir")
+parser.add_argument("--seed", default=0, type=int, dest="seed")
+parser.add_argument("--uint8", default="off", type=str, dest="uint8")
+parser.add_argument("--prefetch", default="on", type=str, dest="prefetch")
+parser.add_argument("--precision", default="fp32", choices=["fp32", "bf16", "fp16"], type=str, dest="precision")
+parser.add_argument("--compile", default="off", choices=["off", "on", "script"], type=str, dest="compile")
+parser.add_argument("--channels_last", default="off", type=str, dest="channels_last")
+parser.add_argument("--fuse", default="off", choices=["off", "on", "relu"], type=str, dest="fuse")
+parser.add_argument("--io_threads", default=2, type=int, dest="io_threads")
+parser.add_argument("--io_queue", default=16, type=int, dest="io_queue")
+parser.add_argument("--num_workers", default="auto", type=str, dest="num_workers")
+
+parser.add_argument("--ny", default=320, type=int, dest="ny")
 parser.add_argument("--nx", default=480, type=int, dest="nx")
-parser.add_argument("--nch", default=3, type=int, dset="nch")
+parser.add_argument("--nch", default=3, type=int, dest="nch")
 parser.add_argument("--nker", default=64, type=int, dest="nker")
 
 parser.add_argument("--network", default="unet", choices=["unet", "resnet", "autoencoder"], type=str, dest="network")
@@ -46,15 +62,31 @@ batch_size = args.batch_size
 num_epoch = args.num_epoch
 
 data_dir = args.data_dir
-ckpt_dir = args.ckpt_dr
+ckpt_dir = args.ckpt_dir
 log_dir = args.log_dir
 result_dir = args.result_dir
 
 mode = args.mode
 train_continue = args.train_continue
+manifest = args.manifest == "on"
+cache_size = args.cache_size * 1024 ** 2
 
 task = args.task
-opts = [args.opts[0], np.asarray(args.opts[1:].astype(np.float))]
+opts = [args.opts[0], np.asarray(args.opts[1:], dtype=np.float64)]
+degradation = args.degradation
+blur_backend = args.blur_backend
+eval_cache = args.eval_cache == "on"
+cache_dir = args.cache_dir
+seed = args.seed
+uint8 = args.uint8 == "on"
+prefetch = args.prefetch == "on"
+precision = args.precision
+compile_mode = args.compile
+channels_last = args.channels_last == "on"
+fuse = args.fuse
+io_threads = args.io_threads
+io_queue = args.io_queue
+num_workers = args.num_workers
 
 ny = args.ny
 nx = args.nx
@@ -65,6 +97,21 @@ network = args.network
 learning_type = args.learning_type
 
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+memory_format = torch.channels_last if channels_last else torch.contiguous_format
+
+fn_prefetch = lambda loader: DevicePrefetcher(loader, device) if prefetch else loader
+
+def fn_loader(dataset, shuffle):
+    kwargs = dict(batch_size=batch_size, shuffle=shuffle, pin_memory=prefetch and device.type == 'cuda')
+
+    kwargs.update(worker_init_fn=seed_worker)
+
+    if num_workers == "auto":
+        return LoaderTuner(dataset, **kwargs)
+    else:
+        return DataLoader(dataset, num_workers=int(num_workers), **kwargs)
+
 ## directory to save png results
 result_dir_train = os.path.join(result_dir, "train")
 result_dir_val = os.path.join(result_dir, "val")
@@ -78,17 +125,29 @@ if not os.path.exists(result_dir):
     os.makedirs(os.path.join(result_dir_test, 'numpy'))
 
 ## transfrom and data loading
+# device: workers return clean labels only, the degradation runs on the whole batch
+task_data = task if degradation == "worker" else None
+fn_degrade = Degradation(task=task, opts=opts, mean=0.5, std=0.5)
+
+# val/test: fixed seed per image and degraded inputs cached on disk
+eval_seed = seed if eval_cache else None
+eval_cache_dir = lambda split: os.path.join(cache_dir, split) if eval_cache else None
 
 #순서대로 일어남
+# FusedTransform = RandomCrop + Normalization + RandomFlip + ToTensor in one float32 allocation
+# --uint8 on: uint8 images leave the workers as uint8 and are normalized on the device
 if mode == "train":
-    transform_train = transforms.Compose([RandomCrop(shape=(ny, nx)), Normalization(mean=0.5, std=0.5), RandomFlip(), ToTensor()])
-    transform_val = transforms.Compose([RandomCrop(shape=(ny, nx)), Normalization(mean=0.5, std=0.5), ToTensor()])
+    transform_train = FusedTransform(shape=(ny, nx), mean=0.5, std=0.5, uint8=uint8)
+    transform_val = FusedTransform(shape=(ny, nx), mean=0.5, std=0.5, flip=False, uint8=uint8)
 
-    dataset_train = Dataset(data_dir=os.path.join(data_dir, 'train'), transform=transform_train, task=task, opts=opts)
-    loader_train = DataLoader(dataset_train, batch_size=batch_size, shuffle=True, num_workers=8)
+    dataset_train = Dataset(data_dir=os.path.join(data_dir, 'train'), transform=transform_train, task=task_data, opts=opts, cache_size=cache_size, manifest=manifest, blur_backend=blur_backend, uint8=uint8)
+    loader_train = fn_loader(dataset_train, shuffle=True)
+    if num_workers == "auto":
+        loader_train.calibrate()
 
-    dataset_val = Dataset(data_dir=os.path.join(data_dir, 'val'), transform=transform_val, task=task, opts=opts)
-    loader_val = DataLoader(dataset_val, batch_size=batch_size, shuffle=True, num_workers=8)
+    dataset_val = Dataset(data_dir=os.path.join(data_dir, 'val'), transform=transform_val, task=task_data, opts=opts, cache_size=cache_size, manifest=manifest, blur_backend=blur_backend, uint8=uint8,
+                          cache_dir=eval_cache_dir('val'), seed=eval_seed)
+    loader_val = fn_loader(dataset_val, shuffle=True)
 
     ##variables
     num_data_train = len(dataset_train)
@@ -97,10 +156,11 @@ if mode == "train":
     num_batch_train = np.ceil(num_data_train / batch_size)
     num_batch_val = np.ceil(num_data_val / batch_size)
 else:
-    transform_test = transforms.Compose([RandomCrop(shape=(ny, nx)), Normalization(mean=0.5, std=0.5), ToTensor()])
+    transform_test = FusedTransform(shape=(ny, nx), mean=0.5, std=0.5, flip=False, uint8=uint8)
 
-    dataset_test = Dataset(data_dir=os.path.join(data_dir, 'test'), transform=transform_test, task=task, opts=opts)
-    loader_test = DataLoader(dataset_test, batch_size=batch_size, shuffle=False, num_workers=8)
+    dataset_test = Dataset(data_dir=os.path.join(data_dir, 'test'), transform=transform_test, task=task_data, opts=opts, cache_size=cache_size, manifest=manifest, blur_backend=blur_backend, uint8=uint8,
+                           cache_dir=eval_cache_dir('test'), seed=eval_seed)
+    loader_test = fn_loader(dataset_test, shuffle=False)
 
     num_data_test = len(dataset_test)
     num_batch_test = np.ceil(num_data_test / batch_size)
@@ -112,6 +172,8 @@ elif network == "autoencoder":
     net = AutoEncoder(nch=nch, nker=nker, norm="bnorm", learning_type=learning_type).to(device)
 # elif network == "resnet":
 #    net = ResNet().to(device)
+net = net.to(memory_format=memory_format)
+
 ## loss function
 #fn_loss = nn.BCEWithLogitsLoss().to(device)
 fn_loss = nn.MSELoss().to(device)
@@ -119,6 +181,27 @@ fn_loss = nn.MSELoss().to(device)
 ## optimizer
 optim = torch.optim.Adam(net.parameters(), lr=lr)
 
+## mixed precision
+amp = Precision(precision, device)
+
+fn_net = net
+
+fn_sample = lambda shape: torch.randn(shape, device=device).contiguous(memory_format=memory_format)
+
+# batch shape the network sees, taken from a degraded sample (srresnet: the downsampled input)
+def fn_shape(dataset):
+    data = dataset[0]
+
+    if degradation == "device":
+        shape = fn_degrade(to_float(data['label'][np.newaxis].to(device), mean=0.5, std=0.5)).shape[1:]
+    else:
+        shape = data['input'].shape
+
+    return (batch_size,) + tuple(shape)
+
+## background image writer
+image_writer = ImageWriter(maxsize=io_queue, num_threads=io_threads, drop=True)
+
 ## output functions
 fn_tonumpy = lambda x: x.to('cpu').detach().numpy().transpose(0, 2, 3, 1)
 fn_denorm = lambda x, mean, std: (x * std) + mean
@@ -137,24 +220,32 @@ if mode =="train": #TRAIN
     if train_continue == "on":
         net, optim, st_epoch = load(ckpt_dir=ckpt_dir, net=net, optim=optim)
 
+    if compile_mode != "off":
+        fn_net = compile_net(net, compile_mode, fn_shape(dataset_train), device, train=True, amp=amp, memory_format=memory_format)
+
     for epoch in range(st_epoch + 1, num_epoch + 1):
-        net.train()
+        fn_net.train()
         loss_arr = []
 
-        for batch, data in enumerate(loader_train, 1):
+        for batch, data in enumerate(fn_prefetch(loader_train), 1):
             # forward pass
-            label = data['label'].to(device)
-            input = data['input'].to(device)
+            label = to_float(data['label'].to(device), mean=0.5, std=0.5, memory_format=memory_format)
+            if degradation == "device":
+                input = fn_degrade(label).contiguous(memory_format=memory_format)
+            else:
+                input = to_float(data['input'].to(device), mean=0.5, std=0.5, memory_format=memory_format)
 
-            output = net(input)
+            with amp.autocast():
+                output = fn_net(input)
+                loss = fn_loss(output, label)
 
             # backward pass
             optim.zero_grad()
 
-            loss = fn_loss(output, label)
-            loss.backward()
+            amp.step(loss, optim)
 
-            optim.step()
+            # bf16/fp16 outputs are written out in fp32
+            output = output.float()
 
             # loss function
             loss_arr += [loss.item()]
@@ -172,9 +263,9 @@ if mode =="train": #TRAIN
 
             id = num_batch_train * (epoch - 1) + batch
 
-            plt.imsave(os.path.join(result_dir_train, 'png', '%04d_label.png' % id), label[0])
-            plt.imsave(os.path.join(result_dir_train, 'png', '%04d_input.png' % id), input[0])
-            plt.imsave(os.path.join(result_dir_train, 'png', '%04d_output.png' % id), output[0])
+            image_writer.imsave(os.path.join(result_dir_train, 'png', '%04d_label.png' % id), label[0])
+            image_writer.imsave(os.path.join(result_dir_train, 'png', '%04d_input.png' % id), input[0])
+            image_writer.imsave(os.path.join(result_dir_train, 'png', '%04d_output.png' % id), output[0])
 
 
             # writer_train.add_image('label', label, num_batch_train * (epoch - 1) + batch, dataformats='NHWC')
@@ -183,19 +274,30 @@ if mode =="train": #TRAIN
 
         writer_train.add_scalar('loss', np.mean(loss_arr), epoch)
 
+    fn_net_val = fn_net
+
+    if fuse != "off":
+        fn_net_val = fuse_for_inference(net, fn_sample(fn_shape(dataset_val)), relu=fuse == "relu")
+
     with torch.no_grad():
-        net.eval()
+        fn_net_val.eval()
         loss_arr = []
 
-        for batch, data in enumerate(loader_val, 1):
+        for batch, data in enumerate(fn_prefetch(loader_val), 1):
             # forward pass
-            label = data['label'].to(device)
-            input = data['input'].to(device)
+            label = to_float(data['label'].to(device), mean=0.5, std=0.5, memory_format=memory_format)
+            if degradation == "device":
+                input = fn_degrade(label).contiguous(memory_format=memory_format)
+            else:
+                input = to_float(data['input'].to(device), mean=0.5, std=0.5, memory_format=memory_format)
 
-            output = net(input)
+            with amp.autocast():
+                output = fn_net_val(input)
 
-            # loss function
-            loss = fn_loss(output, label)
+                # loss function
+                loss = fn_loss(output, label)
+
+            output = output.float()
 
             loss_arr += [loss.item()]
 
@@ -211,9 +313,9 @@ if mode =="train": #TRAIN
 
             id = num_batch_val * (epoch - 1) + batch
 
-            plt.imsave(os.path.join(result_dir_val, 'png', '%04d_label.png' % id), label[0])
-            plt.imsave(os.path.join(result_dir_val, 'png', '%04d_input.png' % id), input[0])
-            plt.imsave(os.path.join(result_dir_val, 'png', '%04d_output.png' % id), output[0])
+            image_writer.imsave(os.path.join(result_dir_val, 'png', '%04d_label.png' % id), label[0])
+            image_writer.imsave(os.path.join(result_dir_val, 'png', '%04d_input.png' % id), input[0])
+            image_writer.imsave(os.path.join(result_dir_val, 'png', '%04d_output.png' % id), output[0])
 
 
             # writer_val.add_image('label', label, num_batch_train * (epoch - 1) + batch, dataformats='NHWC')
@@ -227,23 +329,36 @@ if mode =="train": #TRAIN
 
     writer_train.close()
     writer_val.close()
+    image_writer.close()
 
 else: #TEST
     net, optim, st_epoch = load(ckpt_dir=ckpt_dir, net=net, optim=optim)
 
+    if fuse != "off":
+        fn_net = fuse_for_inference(net, fn_sample(fn_shape(dataset_test)), relu=fuse == "relu")
+
+    if compile_mode != "off":
+        fn_net = compile_net(fn_net.eval(), compile_mode, fn_shape(dataset_test), device, train=False, amp=amp, memory_format=memory_format)
+
     with torch.no_grad():
-        net.eval()
+        fn_net.eval()
         loss_arr = []
 
-        for batch, data in enumerate(loader_test, 1):
+        for batch, data in enumerate(fn_prefetch(loader_test), 1):
             # forward pass
-            label = data['label'].to(device)
-            input = data['input'].to(device)
+            label = to_float(data['label'].to(device), mean=0.5, std=0.5, memory_format=memory_format)
+            if degradation == "device":
+                input = fn_degrade(label).contiguous(memory_format=memory_format)
+            else:
+                input = to_float(data['input'].to(device), mean=0.5, std=0.5, memory_format=memory_format)
 
-            output = net(input)
+            with amp.autocast():
+                output = fn_net(input)
 
-            # loss function
-            loss = fn_loss(output, label)
+                # loss function
+                loss = fn_loss(output, label)
+
+            output = output.float()
 
             loss_arr += [loss.item()]
 
@@ -261,17 +376,19 @@ else: #TEST
                 input_ = input[j]
                 output_ = output[j]
 
-                np.save(os.path.join(result_dir, 'numpy', '%04d_label.npy' % id), label_)
-                np.save(os.path.join(result_dir, 'numpy', '%04d_input.npy' % id), input_)
-                np.save(os.path.join(result_dir, 'numpy', '%04d_output.npy' % id), output_)
+                image_writer.save(os.path.join(result_dir_test, 'numpy', '%04d_label.npy' % id), label_, drop=False)
+                image_writer.save(os.path.join(result_dir_test, 'numpy', '%04d_input.npy' % id), input_, drop=False)
+                image_writer.save(os.path.join(result_dir_test, 'numpy', '%04d_output.npy' % id), output_, drop=False)
 
                 label_ = np.clip(label_, a_min=0, a_max=1)
                 input_ = np.clip(input_, a_min=0, a_max=1)
                 output_ = np.clip(output_, a_min=0, a_max=1)
 
-                plt.imsave(os.path.join(result_dir, 'png', '%04d_label.png' % id), label_)
-                plt.imsave(os.path.join(result_dir, 'png', '%04d_input.png' % id), input_)
-                plt.imsave(os.path.join(result_dir, 'png', '%04d_output.png' % id), output_)
+                image_writer.imsave(os.path.join(result_dir_test, 'png', '%04d_label.png' % id), label_, drop=False)
+                image_writer.imsave(os.path.join(result_dir_test, 'png', '%04d_input.png' % id), input_, drop=False)
+                image_writer.imsave(os.path.join(result_dir_test, 'png', '%04d_output.png' % id), output_, drop=False)
+
+    image_writer.close()
 
     print("AVERAGE TEST:  BATCH %04d / %04d | LOSS %.4f" % (batch, num_batch_test, np.mean(loss_arr)))
 
@@ -0,0 +1,45 @@
+import os
+import sys
+import types
+import importlib
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+## project modules
+# the three projects use the same module names (util, layer, dataset, model), so every
+# project is imported with its own directory on sys.path and taken out of sys.modules again
+MODULES = ('util', 'layer', 'dataset', 'model')
+
+def load_project(name):
+    path = os.path.join(ROOT, name)
+    project = types.SimpleNamespace()
+
+    for module in MODULES:
+        sys.modules.pop(module, None)
+
+    sys.path.insert(0, path)
+
+    try:
+        for module in MODULES:
+            if os.path.exists(os.path.join(path, module + '.py')):
+                setattr(project, module, importlib.import_module(module))
+    finally:
+        sys.path.remove(path)
+
+        for module in MODULES:
+            sys.modules.pop(module, None)
+
+    return project
+
+@pytest.fixture(scope='session')
+def unet():
+    return load_project('pytorch_unet')
+
+@pytest.fixture(scope='session')
+def resnet():
+    return load_project('pytorch_resnet')
+
+@pytest.fixture(scope='session')
+def regression():
+    return load_project('pytorch_unet_regression')
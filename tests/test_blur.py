@@ -0,0 +1,30 @@
+import numpy as np
+import pytest
+
+TYPES = ("nearest", "bilinear", "bicubic", "biquadratic", "biquartic", "biquintic")
+
+@pytest.fixture(params=['resnet', 'regression'])
+def util(request):
+    return request.getfixturevalue(request.param).util
+
+@pytest.mark.parametrize('keepdim', [True, False])
+@pytest.mark.parametrize('dw', [2, 3, 4])
+def test_matrix_matches_skimage(util, dw, keepdim):
+    # odd sizes: the downsampled shape is rounded down
+    err = util.check_blur(shape=(61, 94, 3), dw=dw, keepdim=keepdim, types=TYPES, backends=("matrix",), tol=1e-10)
+
+    assert len(err) == len(TYPES)
+
+def test_matrix_matches_skimage_float32(util):
+    img = np.random.default_rng(1).random((48, 80, 1)).astype(np.float32)
+
+    for type in TYPES:
+        ref = util.add_blur(img, type=type, opts=[4, True], backend="skimage")
+        dst = util.add_blur(img, type=type, opts=[4, True], backend="matrix")
+
+        assert dst.shape == ref.shape
+        np.testing.assert_allclose(dst, ref, atol=1e-6, err_msg=type)
+
+def test_check_blur_raises_above_tol(util):
+    with pytest.raises(ValueError):
+        util.check_blur(types=("bilinear",), backends=("torch",), tol=1e-10)
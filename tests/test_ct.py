@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+import torch
+
+@pytest.mark.parametrize('shape', [(64, 64, 1), (48, 80, 2)])
+@pytest.mark.parametrize('nangle', [180, 60, 30])
+def test_fbp_matches_skimage(resnet, tmp_path, shape, nangle):
+    # diff is 0.04-0.11 here; a factor 2 in the ramp or the back projection scaling gives about 1
+    err = resnet.util.check_ct(shape, nangle, ct_dir=str(tmp_path), tol=0.15)
+
+    assert abs(err['scale'] - 1) < 0.05
+    assert err['matrix'][0] < 2 * err['skimage'][0]
+
+def test_batch_matches_numpy(resnet, tmp_path):
+    img = resnet.util.ct_phantom((48, 80, 2)).astype(np.float32)
+
+    dst = resnet.util.add_ct(img, opts=[60], ct_dir=str(tmp_path))
+
+    batch = torch.from_numpy(img.transpose((2, 0, 1)))[np.newaxis]
+    dst_batch = resnet.util.add_ct_batch(batch, opts=[60], ct_dir=str(tmp_path))[0].numpy().transpose((1, 2, 0))
+
+    np.testing.assert_allclose(dst_batch, dst, atol=1e-4)
+
+def test_operator_cache(resnet, tmp_path):
+    angles = tuple(resnet.util.ct_angles(30))
+
+    A, At, ndet = resnet.util.ct_operator((24, 40), angles, str(tmp_path))
+
+    # two detector bins per pixel and angle, the transpose is stored as well
+    assert A.nnz == At.nnz == 2 * 24 * 40 * 30
+    assert len(list(tmp_path.iterdir())) == 1
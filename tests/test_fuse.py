@@ -0,0 +1,51 @@
+import pytest
+import torch
+import torch.nn as nn
+
+from common.runtime import fuse_for_inference
+
+def randomize_bn(net):
+    # trained running statistics and affine parameters instead of the 0/1 defaults
+    gen = torch.Generator().manual_seed(0)
+
+    for module in net.modules():
+        if isinstance(module, nn.BatchNorm2d):
+            with torch.no_grad():
+                module.running_mean.copy_(torch.randn(module.num_features, generator=gen))
+                module.running_var.copy_(torch.rand(module.num_features, generator=gen) + 0.5)
+                module.weight.copy_(torch.randn(module.num_features, generator=gen))
+                module.bias.copy_(torch.randn(module.num_features, generator=gen))
+
+    return net.eval()
+
+def networks(unet, resnet, regression):
+    return [
+        ('unet', unet.model.UNet(), (1, 1, 32, 32)),
+        ('resnet unet', resnet.model.UNet(in_channels=3, out_channels=3, nker=8), (2, 3, 32, 48)),
+        ('resnet', resnet.model.ResNet(in_channels=3, out_channels=3, nker=8, nblk=2), (2, 3, 24, 32)),
+        ('srresnet', resnet.model.SRResNet(in_channels=3, out_channels=3, nker=8, nblk=2), (2, 3, 12, 16)),
+        ('regression autoencoder', regression.model.AutoEncoder(nch=3, nker=8), (2, 3, 32, 48)),
+    ]
+
+@pytest.mark.parametrize('relu', [False, True])
+def test_fused_matches_unfused(unet, resnet, regression, relu):
+    torch.manual_seed(0)
+
+    for name, net, shape in networks(unet, resnet, regression):
+        net = randomize_bn(net)
+        x = torch.randn(shape)
+
+        net_fused = fuse_for_inference(net, relu=relu)
+
+        assert not any(isinstance(m, nn.BatchNorm2d) for m in net_fused.modules()), name
+
+        with torch.no_grad():
+            y = net(x)
+            y_fused = net_fused(x)
+
+        torch.testing.assert_close(y_fused, y, rtol=1e-4, atol=1e-4 * y.abs().max().item(), msg=name)
+
+def test_failed_check_keeps_unfused(resnet):
+    net = randomize_bn(resnet.model.ResNet(in_channels=3, out_channels=3, nker=8, nblk=2))
+
+    assert fuse_for_inference(net, torch.randn(1, 3, 16, 16), rtol=-1) is net
@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+
+def frames(n, sz=(12, 20, 1)):
+    rng = np.random.default_rng(0)
+    lst_label = [rng.integers(0, 256, sz, dtype=np.uint8) for _ in range(n)]
+    lst_input = [rng.integers(0, 256, sz, dtype=np.uint8) for _ in range(n)]
+
+    return lst_label, lst_input
+
+def check(unet, path, lst_label, lst_input):
+    dataset = unet.dataset.ShardDataset(str(path))
+
+    assert len(dataset) == len(lst_label)
+
+    for i in range(len(dataset)):
+        label, input = dataset.read(i)
+
+        np.testing.assert_array_equal(label, lst_label[i])
+        np.testing.assert_array_equal(input, lst_input[i])
+
+def test_round_trip(unet, tmp_path):
+    path = tmp_path / 'train.shard'
+    lst_label, lst_input = frames(5)
+
+    unet.util.save_shard(str(path), lst_label, lst_input)
+
+    check(unet, path, lst_label, lst_input)
+
+def test_resume(unet, tmp_path):
+    path = tmp_path / 'train.shard'
+    lst_label, lst_input = frames(6)
+    sz = lst_label[0].shape
+
+    # interrupted conversion: frames 0, 2 and 5 are on disk, written out of order
+    writer = unet.util.ShardWriter(str(path), 6, sz)
+    for i in [5, 0, 2]:
+        writer.write(i, lst_label[i], lst_input[i])
+    writer.close()
+
+    with pytest.raises(ValueError, match='data_load.py'):
+        unet.util.load_shard(str(path))
+
+    with pytest.raises(ValueError):
+        unet.dataset.ShardDataset(str(path))
+
+    writer = unet.util.ShardWriter(str(path), 6, sz, resume=True)
+    assert [writer.done(i) for i in range(6)] == [True, False, True, False, False, True]
+
+    for i in range(6):
+        if not writer.done(i):
+            writer.write(i, lst_label[i], lst_input[i])
+    writer.close()
+
+    check(unet, path, lst_label, lst_input)
+
+def test_rejects_other_frame_size(unet, tmp_path):
+    lst_label, lst_input = frames(1)
+    writer = unet.util.ShardWriter(str(tmp_path / 'train.shard'), 1, lst_label[0].shape)
+
+    with pytest.raises(ValueError):
+        writer.write(0, lst_label[0][:-1], lst_input[0][:-1])
+    with pytest.raises(ValueError):
+        writer.write(0, lst_label[0].astype(np.float32), lst_input[0])
+
+    writer.close()
@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+import torch
+
+@pytest.fixture(params=['resnet', 'regression'])
+def project(request):
+    return request.getfixturevalue(request.param)
+
+def sample(seed):
+    rng = np.random.default_rng(seed)
+
+    # uint8 label as it leaves the Dataset, float input as left by the degradation
+    return {'label': rng.integers(0, 256, (40, 56, 3), dtype=np.uint8),
+            'input': rng.random((40, 56, 3))}
+
+def chain(dataset, shape, mean, std):
+    # the transform chain FusedTransform replaces
+    return lambda data: dataset.ToTensor()(dataset.RandomFlip()(dataset.Normalization(mean=mean, std=std)(
+        dataset.RandomCrop(shape=shape)(data))))
+
+@pytest.mark.parametrize('mean, std', [(0.5, 0.5), (0.2, 0.7)])
+def test_fused_matches_chain(project, mean, std):
+    for seed in range(8):
+        np.random.seed(seed)
+        ref = chain(project.dataset, (24, 32), mean, std)(sample(seed))
+
+        np.random.seed(seed)
+        dst = project.dataset.FusedTransform(shape=(24, 32), mean=mean, std=std)(sample(seed))
+
+        for key in ref:
+            assert dst[key].dtype == torch.float32 and dst[key].is_contiguous()
+            torch.testing.assert_close(dst[key], ref[key], rtol=0, atol=1e-6)
+
+def test_fused_uint8_matches_chain(project):
+    # --uint8 on: the label leaves as uint8 and is normalized on the device
+    for seed in range(4):
+        np.random.seed(seed)
+        ref = chain(project.dataset, (24, 32), 0.5, 0.5)(sample(seed))
+
+        np.random.seed(seed)
+        dst = project.dataset.FusedTransform(shape=(24, 32), mean=0.5, std=0.5, uint8=True)(sample(seed))
+
+        assert dst['label'].dtype == torch.uint8
+        torch.testing.assert_close(project.util.to_float(dst['label'], mean=0.5, std=0.5), ref['label'], rtol=0, atol=1e-6)
+        torch.testing.assert_close(dst['input'], ref['input'], rtol=0, atol=1e-6)